@@ -0,0 +1,240 @@
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import db_utils
+import data_scraping_utils
+import finance_utils
+import matching_utils
+import matrix_utils
+
+# Declare class variables
+
+# every synthetic input is generated from this seed, so runs are comparable across commits
+BENCHMARK_SEED = 2025
+
+# positions per synthetic N-PORT filing
+FILING_SIZES = (500, 4000, 20000)
+
+# users per synthetic portfolio set
+USER_COUNTS = (1, 1000, 100000)
+
+# a smaller configuration for quick local runs (python cli.py benchmark --quick)
+QUICK_FILING_SIZES = (500, 4000)
+QUICK_USER_COUNTS = (1, 1000)
+
+# synthetic funds in the seeded database, each user holds FUNDS_PER_USER of them
+BENCHMARK_FUNDS = 20
+FUNDS_PER_USER = 3
+
+# companies asked about by the matching and exposure benchmarks
+BENCHMARK_COMPANIES = 500
+
+# timed rounds per benchmark (the median is compared)
+BENCHMARK_ROUNDS = 5
+
+# a benchmark regresses when its median is this much slower than the baseline's
+REGRESSION_THRESHOLD = 0.2
+
+# ─────────────────────────────────────────────
+# synthetic data
+# ─────────────────────────────────────────────
+
+# [ (name, title, lei, cusip, pct_val, val_usd) ] of n_positions positions drawn from a universe of companies shared by every fund
+def synthetic_holdings(n_positions, seed=BENCHMARK_SEED):
+    rng = random.Random(seed + n_positions)
+    universe = max(n_positions * 2, 1000)
+    holdings = []
+    for company in rng.sample(range(universe), n_positions):
+        name = f"Synthetic Company {company} Inc"
+        lei = f"{company:020d}" if company % 3 else ""
+        cusip = f"{company:09d}" if company % 2 else ""
+        holdings.append((name, name.upper(), lei, cusip, round(rng.uniform(0.001, 2.0), 6), round(rng.uniform(1e3, 1e8), 2)))
+    return holdings
+
+# wrap holdings in an SGML .txt N-PORT filing shaped like the SEC's
+def synthetic_nport_document(holdings):
+    positions = "".join(
+        f"""
+      <invstOrSec>
+        <name>{name}</name>
+        <lei>{lei or "N/A"}</lei>
+        <title>{title}</title>
+        <cusip>{cusip or "N/A"}</cusip>
+        <valUSD>{val_usd}</valUSD>
+        <pctVal>{pct_val}</pctVal>
+      </invstOrSec>"""
+        for name, title, lei, cusip, pct_val, val_usd in holdings
+    )
+    return f"""<SEC-DOCUMENT>0000000000-25-000000.txt
+<TYPE>NPORT-P
+<TEXT>
+<XML>
+<?xml version="1.0" encoding="UTF-8"?>
+<edgarSubmission xmlns="http://www.sec.gov/edgar/nport">
+  <formData>
+    <invstOrSecs>{positions}
+    </invstOrSecs>
+  </formData>
+</edgarSubmission>
+</XML>
+</TEXT>
+</SEC-DOCUMENT>
+"""
+
+# [ (user, fund, amount) ] positions of n_users users
+def synthetic_portfolios(n_users, seed=BENCHMARK_SEED):
+    rng = random.Random(seed + n_users)
+    funds = [f"FUND{i}" for i in range(BENCHMARK_FUNDS)]
+    return [(user, fund, rng.randint(1, 10000)) for user in range(1, n_users + 1) for fund in rng.sample(funds, FUNDS_PER_USER)]
+
+# company queries mixing names and identifiers of the synthetic universe
+def synthetic_companies(n_companies, holdings):
+    rng = random.Random(BENCHMARK_SEED + n_companies)
+    picked = rng.sample(holdings, min(n_companies, len(holdings)))
+    return [lei or cusip or name for name, title, lei, cusip, pct_val, val_usd in picked]
+
+# seed a fresh database file with BENCHMARK_FUNDS funds of filing_size positions and the portfolios of n_users users
+def seed_database(path, filing_size, n_users):
+    conn = db_utils.configure_connection(sqlite3.connect(path, cached_statements=db_utils.STATEMENT_CACHE_SIZE))
+    db_utils.migrate_schema(conn)
+
+    conn.executemany("INSERT INTO funds (ticker) VALUES (?)", [(f"FUND{i}",) for i in range(BENCHMARK_FUNDS)])
+    for i in range(BENCHMARK_FUNDS):
+        db_utils.store_fund_holdings(f"FUND{i}", synthetic_holdings(filing_size, BENCHMARK_SEED + i), conn)
+    db_utils.import_portfolio_positions(synthetic_portfolios(n_users), conn)
+    conn.commit()
+
+    return conn
+
+# ─────────────────────────────────────────────
+# runner
+# ─────────────────────────────────────────────
+
+# run function rounds times (after one untimed warm-up, setup runs untimed before every call)
+# { "median": seconds, "min": seconds, "rounds": rounds }
+def time_benchmark(function, rounds=BENCHMARK_ROUNDS, setup=None):
+    if setup: setup()
+    function()
+
+    timings = []
+    for _ in range(rounds):
+        if setup: setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return {"median": statistics.median(timings), "min": min(timings), "rounds": rounds}
+
+# (name, function, setup) for every parse, match, database and end-to-end benchmark at the given sizes
+def collect_benchmarks(filing_sizes, user_counts, workdir):
+    benchmarks = []
+
+    for size in filing_sizes:
+        holdings = synthetic_holdings(size)
+        document = synthetic_nport_document(holdings).encode()
+        chunks = [document[i:i + data_scraping_utils.NPORT_CHUNK_SIZE] for i in range(0, len(document), data_scraping_utils.NPORT_CHUNK_SIZE)]
+        companies = synthetic_companies(BENCHMARK_COMPANIES, holdings)
+        company_keys = {company: db_utils.company_query_keys(company) for company in companies}
+        matcher = matching_utils.NameMatcher([name for name, *_ in holdings[:BENCHMARK_COMPANIES]])
+
+        benchmarks += [
+            (f"parse/nport/{size}", lambda chunks=chunks: list(data_scraping_utils.iter_nport_holdings(chunks)), None),
+            (f"match/identifiers/{size}", lambda h=holdings, k=company_keys: finance_utils.scan_fund_holdings(h, 1, k), None),
+            (f"match/names/{size}", lambda h=holdings, m=matcher: finance_utils.search_fund_holdings(h, 1, m), None),
+            (f"matrix/weights/{size}", lambda h=holdings: matrix_utils.build_weight_matrix({f"FUND{i}": h for i in range(BENCHMARK_FUNDS)}), None),
+        ]
+
+    filing_size = filing_sizes[0]
+    for n_users in user_counts:
+        conn = seed_database(os.path.join(workdir, f"bench_{n_users}.db"), filing_size, n_users)
+        funds = [f"FUND{i}" for i in range(BENCHMARK_FUNDS)]
+        companies = synthetic_companies(BENCHMARK_COMPANIES, synthetic_holdings(filing_size))
+        rows = synthetic_portfolios(n_users)
+
+        benchmarks += [
+            (f"db/load_user_portfolio/{n_users}", lambda c=conn, n=n_users: db_utils.load_user_portfolio(n // 2 + 1, c), None),
+            (f"db/load_portfolios/{n_users}", lambda c=conn: db_utils.load_portfolios(None, c), None),
+            (f"db/import_portfolios/{n_users}", lambda c=conn, r=rows: db_utils.import_portfolio_positions(r, c), lambda c=conn: (c.execute("DELETE FROM portfolios"), c.commit())),
+            (f"e2e/compute_exposures/{n_users}", lambda c=conn, q=companies: finance_utils.compute_exposures(1, q, c), lambda c=conn: db_utils.invalidate_exposure_results(None, c)),
+            (f"e2e/compute_exposures_memoized/{n_users}", lambda c=conn, q=companies: finance_utils.compute_exposures(1, q, c), None),
+            (f"e2e/compute_exposures_many/{n_users}", lambda c=conn, q=companies, n=n_users: finance_utils.compute_exposures_many(range(1, n + 1), q[:20], c), None),
+            (f"e2e/calculate_all_exposures_many/{n_users}", lambda c=conn: matrix_utils.calculate_all_exposures_many(None, 10, c), None),
+        ]
+
+        benchmarks.append((f"db/load_fund_holdings_cold/{n_users}", lambda c=conn: db_utils.load_fund_holdings(funds, c), db_utils.HOLDINGS_CACHE.clear))
+
+    return benchmarks
+
+# run every benchmark and return the JSON-ready report
+def run_benchmarks(filing_sizes=FILING_SIZES, user_counts=USER_COUNTS, rounds=BENCHMARK_ROUNDS):
+    report = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": BENCHMARK_SEED,
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # the columnar cache is keyed by content hash and the seeded funds have none, keep it out of the way anyway
+        cache_dir, matrix_utils.HOLDINGS_CACHE_DIR = matrix_utils.HOLDINGS_CACHE_DIR, None
+        try:
+            for name, function, setup in collect_benchmarks(filing_sizes, user_counts, workdir):
+                report["results"][name] = time_benchmark(function, rounds, setup)
+                print(f"{name:<48} {report['results'][name]['median'] * 1000:>12.3f} ms")
+        finally:
+            matrix_utils.HOLDINGS_CACHE_DIR = cache_dir
+            db_utils.HOLDINGS_CACHE.clear()
+
+    return report
+
+# the git commit being measured, or None outside a git checkout
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# compare a report against a baseline report
+# [ (name, baseline median, current median, ratio) ] of the benchmarks slower than the baseline by more than threshold
+def find_regressions(report, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for name, result in report["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None or previous["median"] <= 0:
+            continue
+        ratio = result["median"] / previous["median"]
+        if ratio > 1 + threshold:
+            regressions.append((name, previous["median"], result["median"], ratio))
+    return regressions
+
+# run the suite, write the report to output and fail (exit 1) on regressions against the baseline report
+def main(output=None, baseline=None, threshold=REGRESSION_THRESHOLD, quick=False):
+    if quick:
+        report = run_benchmarks(QUICK_FILING_SIZES, QUICK_USER_COUNTS)
+    else:
+        report = run_benchmarks()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote benchmark results to {output}")
+
+    if baseline:
+        with open(baseline, "r") as f:
+            regressions = find_regressions(report, json.load(f), threshold)
+        for name, previous, current, ratio in regressions:
+            print(f"REGRESSION {name}: {previous * 1000:.3f} ms --> {current * 1000:.3f} ms ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {threshold:.0%} against {baseline}")
+
+    return report
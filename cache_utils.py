@@ -0,0 +1,86 @@
+import sys
+import threading
+from collections import OrderedDict
+
+# approximate in-memory size of a value in bytes (the container plus everything nested in it, shared objects counted again)
+def approximate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+# thread-safe least-recently-used cache bounded by the approximate byte size of its values
+# each entry carries a version (e.g. the content hash of the filing it was built from), a lookup for another version is a miss
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key --> (version, value, size), least recently used first
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    # return the cached value (marking it most recently used), or None on a miss
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    # cache a value, evicting least recently used entries until the cache fits in max_bytes again
+    # values larger than the whole cache are not kept
+    def put(self, key, value, version=None):
+        size = approximate_size(value)
+        with self.lock:
+            self.remove(key)
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (version, value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_key = next(iter(self.entries))
+                self.remove(evicted_key)
+                self.evictions += 1
+        return
+
+    # drop a key (whatever its version)
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        return
+
+    # hit/miss counters and current footprint
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    # unlocked removal, callers hold the lock
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return
@@ -1,21 +1,275 @@
 import sys
 
-import db_utils
-import finance_utils
-import data_scraping_utils
+import instrumentation_utils
+import service_client
 
 USAGE = """
-Usage: python cli.py <command> [args]
+Usage: python cli.py <command> [args] [--metrics json|prometheus] [--profile] [--remote [--host 127.0.0.1] [--port 8765]]
 
   init-db
   portfolio        <user_id>
   add-holding      <user_id> <ticker> <shares>
   delete-portfolio <user_id>
+  import-portfolios <file.csv|file.parquet>
+  export-portfolios <file.csv|file.parquet>
   get-url          <ticker>
   set-url          <ticker> <url>
-  exposures        <user_id> <company>/[company ...]
+  set-cusip        <ticker> <cusip>
+  holdings-changes <ticker> [--since YYYY-MM-DD]
+  exposures        <user_id> [--engine index|thread|process|search] <company|ticker|LEI|CUSIP|CIK> [...]
+  exposures-all    <user_id> [--top N]
+  exposure-history <user_id> [--from YYYY-MM-DD] [--to YYYY-MM-DD] <company|ticker|LEI|CUSIP|CIK> [...]
+  benchmark        [--quick] [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+  serve            [--host 127.0.0.1] [--port 8765]
+  service-stats    [--host 127.0.0.1] [--port 8765]
+
+  --metrics prints the spans and counters measured while the command ran, --profile prints its cProfile report (inside the --metrics json output when given)
+  --remote asks the exposure service listening on --host/--port (serve) instead of this process (portfolio, exposures, exposures-all, exposure-history)
 """
 
+# formats the measurements of a command can be printed in (--metrics)
+METRICS_FORMATS = {"json": instrumentation_utils.export_json, "prometheus": instrumentation_utils.export_prometheus}
+
+# command --> (handler, whether a running exposure service can answer it), filled in by @command
+# handlers import the modules they need themselves, so scripted calls of e.g. portfolio never load requests, dotenv or numpy
+COMMANDS = {}
+
+# register a handler as a command, remote handlers are called with (args, remote) and the others with (args)
+# remote is the (host, port) of the exposure service to ask, None to answer in this process
+def command(name, remote=False):
+    def register(handler):
+        COMMANDS[name] = (handler, remote)
+        return handler
+    return register
+
+# remove "--name value" from the argument list and return the value (or the default when absent)
+def pop_option(args, name, default=None):
+    if name not in args:
+        return default
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+@command("init-db")
+def init_db(rest):
+    import db_utils
+    db_utils.initialize_tables()
+
+@command("portfolio", remote=True)
+def show_portfolio(rest, remote):
+    user_id = int(rest[0])
+    if remote:
+        portfolio = service_client.call("portfolio", [user_id], *remote)
+    else:
+        import db_utils
+        portfolio = db_utils.load_user_portfolio(user_id)
+
+    if not portfolio:
+        print(f"No holdings found for user {user_id}.")
+    else:
+        print(f"{'Fund':<16} {'Shares':>10}\n")
+        print(f"{'-'*16} {'-'*10}")
+        for fund, amount in portfolio:
+            print(f"{fund:<16} {amount:>10,}")
+
+@command("add-holding")
+def add_holding(rest):
+    import db_utils
+    user_id, ticker, shares = int(rest[0]), rest[1], int(rest[2])
+    db_utils.insert_portfolio_position(ticker, shares, user_id)
+    print(f"Added {shares:,} shares of {ticker} to user {user_id}.")
+
+@command("delete-portfolio")
+def delete_portfolio(rest):
+    import db_utils
+    user_id = int(rest[0])
+    confirm = input(f"Delete ALL holdings for user {user_id}? [y/N] ").strip().lower()
+    if confirm == "y":
+        db_utils.delete_user_portfolio(user_id)
+        print(f"Deleted all holdings for user {user_id}.")
+    else:
+        print("Aborted.")
+
+@command("import-portfolios")
+def import_portfolios(rest):
+    import db_utils
+    imported, rejected = db_utils.import_portfolio_positions(db_utils.read_portfolio_file(rest[0]))
+    for row_number, row, reason in rejected[:10]:
+        print(f"Skipped row {row_number} {row}: {reason}")
+    print(f"Imported {imported:,} positions ({len(rejected):,} rejected).")
+
+@command("export-portfolios")
+def export_portfolios(rest):
+    import db_utils
+    written = db_utils.write_portfolio_file(rest[0], db_utils.iter_portfolio_positions())
+    print(f"Exported {written:,} positions to {rest[0]}.")
+
+@command("get-url")
+def get_url(rest):
+    import db_utils
+    url = db_utils.get_sec_url(rest[0])
+    print(url if url else f"No URL found for {rest[0]}.")
+
+@command("set-url")
+def set_url(rest):
+    import db_utils
+    ticker, url = rest[0], rest[1]
+    db_utils.update_existing_fund(ticker, sec_url=url)
+    print(f"Updated SEC URL for {ticker}.")
+
+@command("set-cusip")
+def set_cusip(rest):
+    import db_utils
+    ticker, cusip = rest[0], rest[1]
+    db_utils.update_existing_fund(ticker, cusip=cusip)
+    print(f"Updated CUSIP for {ticker}. Funds holding it will be looked through.")
+
+@command("holdings-changes")
+def holdings_changes(rest):
+    import db_utils
+    since = pop_option(rest, "--since")
+    ticker = rest[0]
+    changes = db_utils.load_holdings_changes(ticker, since)
+    if not changes:
+        print(f"No holdings changes recorded for {ticker}.")
+    else:
+        print(f"{'Recorded':<19} {'Change':<8} {'Holding':<40} {'Old %':>8} {'New %':>8}\n")
+        print(f"{'-'*19} {'-'*8} {'-'*40} {'-'*8} {'-'*8}")
+        for recorded, content_hash, change, key, name, old_pct_val, pct_val, old_val_usd, val_usd in changes:
+            old_pct = f"{old_pct_val:.3f}" if old_pct_val is not None else "-"
+            new_pct = f"{pct_val:.3f}" if pct_val is not None else "-"
+            print(f"{recorded[:19]:<19} {change:<8} {(name or key)[:40]:<40} {old_pct:>8} {new_pct:>8}")
+
+@command("delete-table")
+def delete_table(rest):
+    import db_utils
+    table_name = rest[0]
+    db_utils.delete_table(table_name)
+
+@command("exposures", remote=True)
+def show_exposures(rest, remote):
+    import finance_utils
+    engine = pop_option(rest, "--engine", "index")
+    if engine not in finance_utils.ENGINES:
+        raise ValueError(f"unknown engine {engine}")
+    user_id, companies = int(rest[0]), rest[1:]
+    if remote:
+        exposures = service_client.call("exposures", [user_id, companies, engine], *remote)
+    else:
+        exposures = finance_utils.compute_exposures(user_id, companies, engine=engine)
+    finance_utils.print_exposures(exposures)
+
+@command("exposures-all", remote=True)
+def show_exposures_all(rest, remote):
+    top_n = pop_option(rest, "--top")
+    top_n = int(top_n) if top_n is not None else None
+    user_id = int(rest[0])
+    if remote:
+        exposures = service_client.call("exposures_all", [user_id, top_n], *remote)
+    else:
+        import matrix_utils
+        exposures = matrix_utils.calculate_all_exposures(user_id, top_n)
+
+    if not exposures:
+        print(f"No exposures found for user {user_id}.")
+    else:
+        print(f"{'Company':<40} {'Exposure':>16}\n")
+        print(f"{'-'*40} {'-'*16}")
+        for company, amount in exposures:
+            print(f"{company[:40]:<40} {f'${amount:,.2f}':>16}")
+
+@command("exposure-history", remote=True)
+def show_exposure_history(rest, remote):
+    start = pop_option(rest, "--from")
+    end = pop_option(rest, "--to")
+    user_id, companies = int(rest[0]), rest[1:]
+    if not companies:
+        raise ValueError("no companies given")
+    if remote:
+        history = service_client.call("exposure_history", [user_id, companies, start, end], *remote)
+    else:
+        import matrix_utils
+        history = matrix_utils.calculate_exposure_history(user_id, companies, start, end)
+
+    # the series of every company share the same report periods, so they are either all empty or all filled
+    if not any(history.get(company) for company in companies):
+        print(f"No filing history found for user {user_id}'s funds.")
+        return
+
+    for company in companies:
+        series = history.get(company, [])
+        if not series:
+            print(f"\nNo exposure history found for {company}.")
+            continue
+        print(f"\n{company}\n")
+        print(f"{'Period':<12} {'Exposure':>16} {'Change':>16}")
+        print(f"{'-'*12} {'-'*16} {'-'*16}")
+        previous = None
+        for report_period, amount in series:
+            change = f"{amount - previous:+,.2f}" if previous is not None else ""
+            print(f"{report_period:<12} {f'${amount:,.2f}':>16} {change:>16}")
+            previous = amount
+
+@command("benchmark")
+def benchmark(rest):
+    import benchmarks
+    quick = "--quick" in rest
+    output = pop_option(rest, "--output")
+    baseline = pop_option(rest, "--baseline")
+    threshold = float(pop_option(rest, "--threshold", benchmarks.REGRESSION_THRESHOLD))
+    benchmarks.main(output, baseline, threshold, quick)
+
+@command("serve")
+def serve(rest):
+    import exposure_service
+    host = pop_option(rest, "--host", service_client.SERVICE_HOST)
+    port = int(pop_option(rest, "--port", service_client.SERVICE_PORT))
+    exposure_service.main(host, port)
+
+@command("service-stats")
+def service_stats(rest):
+    import json
+    host = pop_option(rest, "--host", service_client.SERVICE_HOST)
+    port = int(pop_option(rest, "--port", service_client.SERVICE_PORT))
+    print(json.dumps(service_client.call("stats", None, host, port), indent=2))
+
+@command("get-company-data")
+def get_company_data(rest):
+    import data_scraping_utils
+    data_scraping_utils.fetch_company_data()
+
+@command("fetch-nport")
+def fetch_nport(rest):
+    import data_scraping_utils
+    nport = data_scraping_utils.fetch_nport_from_sec_url(rest[0])
+    if nport is None:
+        print(f"No N-PORT filing fetched for {rest[0]}.")
+        sys.exit(1)
+    print(nport)
+
+@command("refresh")
+def refresh(rest):
+    import db_utils
+    import matrix_utils
+    db_utils.refresh_all_fund_data()
+    matrix_utils.populate_holdings_cache()
+
+# run one command, its arguments already stripped of --metrics, --profile and --remote (remote: None or the service's (host, port))
+def run_command(cmd, rest, remote=None):
+    if cmd not in COMMANDS:
+        print(f"Unknown command: '{cmd}'.{USAGE}")
+        sys.exit(1)
+
+    handler, supports_remote = COMMANDS[cmd]
+    if supports_remote:
+        handler(rest, remote)
+    elif remote:
+        raise ValueError(f"{cmd} cannot run --remote")
+    else:
+        handler(rest)
+    return
+
 def main():
     args = sys.argv[1:]
     if not args:
@@ -25,74 +279,36 @@ def main():
     cmd, rest = args[0], args[1:]
 
     try:
-        if cmd == "init-db":
-            db_utils.initialize_tables()
-
-        elif cmd == "portfolio":
-            user_id = int(rest[0])
-            portfolio = db_utils.load_user_portfolio(user_id)
-            if not portfolio:
-                print(f"No holdings found for user {user_id}.")
-            else:
-                print(f"{'Fund':<16} {'Shares':>10}\n")
-                print(f"{'-'*16} {'-'*10}")
-                for fund, amount in portfolio:
-                    print(f"{fund:<16} {amount:>10,}")
-
-        elif cmd == "add-holding":
-            user_id, ticker, shares = int(rest[0]), rest[1], int(rest[2])
-            db_utils.insert_portfolio_position(ticker, shares, user_id)
-            print(f"Added {shares:,} shares of {ticker} to user {user_id}.")
-
-        elif cmd == "delete-portfolio":
-            user_id = int(rest[0])
-            confirm = input(f"Delete ALL holdings for user {user_id}? [y/N] ").strip().lower()
-            if confirm == "y":
-                db_utils.delete_user_portfolio(user_id)
-                print(f"Deleted all holdings for user {user_id}.")
-            else:
-                print("Aborted.")
-
-        elif cmd == "get-url":
-            url = db_utils.get_sec_url(rest[0])
-            print(url if url else f"No URL found for {rest[0]}.")
-
-        elif cmd == "set-url":
-            ticker, url = rest[0], rest[1]
-            db_utils.update_existing_fund(ticker, sec_url=url)
-            print(f"Updated SEC URL for {ticker}.")
-
-        elif cmd == "delete-table":
-            table_name = rest[0]
-            db_utils.delete_table(table_name)
-
-        elif cmd == "exposures":
-            user_id, companies = int(rest[0]), rest[1:]
-            finance_utils.USER = user_id
-            finance_utils.COMPANIES_TO_SEARCH_KEYS = companies
-            finance_utils.COMPANIES_TO_SEARCH = dict.fromkeys(companies, 0.0)
-            finance_utils.determine_portfolio_exposure()
-
-        elif cmd == "get-company-data":
-            data_scraping_utils.fetch_company_data()
-
-        elif cmd == "fetch-nport":
-            nport = data_scraping_utils.fetch_nport_from_sec_url(rest[0])
-            if nport is None:
-                print(f"No URL found for {rest[0]}.")
-                sys.exit(1)
-            print(nport)
-
-        elif cmd == "refresh":
-            db_utils.refresh_all_fund_data()
-
-        else:
-            print(f"Unknown command: '{cmd}'.{USAGE}")
-            sys.exit(1)
+        metrics = pop_option(rest, "--metrics")
+        if metrics is not None and metrics not in METRICS_FORMATS:
+            raise ValueError(f"unknown metrics format {metrics}")
+        profile = "--profile" in rest
+        if profile:
+            rest.remove("--profile")
+            instrumentation_utils.PROFILED_SPANS.add(cmd)
+        remote = None
+        if "--remote" in rest:
+            rest.remove("--remote")
+            remote = (pop_option(rest, "--host", service_client.SERVICE_HOST), int(pop_option(rest, "--port", service_client.SERVICE_PORT)))
+
+        with instrumentation_utils.span(cmd):
+            run_command(cmd, rest, remote)
+
+        if metrics is not None:
+            print(METRICS_FORMATS[metrics]())
+        # the JSON export already carries the reports, the Prometheus format has no place for them
+        if profile and metrics != "json":
+            print(instrumentation_utils.export_profiles())
 
     except (IndexError, ValueError):
         print(f"Invalid arguments for '{cmd}'.{USAGE}")
         sys.exit(1)
+    except service_client.ServiceError as e:
+        print(f"Exposure service error: {e}")
+        sys.exit(1)
+    except ConnectionRefusedError as e:
+        print(f"{e}, start one with: python cli.py serve")
+        sys.exit(1)
     except (TypeError):
         print("Could not find composition data for Vanguard or Fidelity funds")
         sys.exit(1)
@@ -101,4 +317,4 @@ def main():
         sys.exit(0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
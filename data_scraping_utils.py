@@ -3,15 +3,111 @@ import os
 import re
 import csv
 import json
+import time
+import hashlib
+import zlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import db_utils
+import matching_utils
+import instrumentation_utils
 from dotenv import load_dotenv
 
+# SEC fair-access policy: no more than 10 requests per second per client
+SEC_MAX_REQUESTS_PER_SECOND = 10
+
+# concurrent downloads used by refresh (they still share the SEC rate limit)
+REFRESH_WORKERS = 4
+
+# retry throttled/unavailable responses with exponential backoff: 0.5s, 1s, 2s, ...
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.5
+
+REQUEST_TIMEOUT_SECONDS = 30
+
+# token bucket shared by every thread making SEC requests
+# capacity defaults to a single token so requests are spaced evenly and no 1-second window can burst past the rate
+class RateLimiter:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    # block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+SEC_RATE_LIMITER = RateLimiter(SEC_MAX_REQUESTS_PER_SECOND)
+SEC_SESSION = None
+ENVIRONMENT_LOADED = False
+
+# read .env (USER_AGENT_EMAIL) into the environment once per process instead of on every fetch
+def load_environment():
+    global ENVIRONMENT_LOADED
+    if not ENVIRONMENT_LOADED:
+        load_dotenv()
+        ENVIRONMENT_LOADED = True
+    return
+
+# one keep-alive session (with the SEC User-Agent already set) reused for every request in the process
+def get_sec_session():
+    global SEC_SESSION
+    if SEC_SESSION is None:
+        load_environment()
+        email = os.getenv("USER_AGENT_EMAIL")
+
+        session = requests.Session()
+        session.headers["User-Agent"] = f"PersonalInvestmentApp {email}"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=REFRESH_WORKERS, pool_maxsize=REFRESH_WORKERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        SEC_SESSION = session
+
+    return SEC_SESSION
+
+# GET a url under the SEC rate limit, retrying with backoff on 429/503 responses and connection errors
+@instrumentation_utils.span("fetch")
+def fetch_with_retry(session, url, limiter=None, **kwargs):
+    if limiter is None:
+        limiter = SEC_RATE_LIMITER
+
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = session.get(url, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return response
+
+            # honour the server's Retry-After when it sends one
+            retry_after = response.headers.get("Retry-After", "")
+            response.close()
+            if retry_after.isdigit():
+                time.sleep(int(retry_after))
+                continue
+
+        time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
 # determine the sec url to use for the fund by checking local and then programmatically searching EDGAR if needed
 # [MVP]: lookup into dictionary/database, no handling if fund not found
+# fetched over the shared SEC session under the rate limit, like every other download; None if there is no url or the SEC refuses
 def fetch_nport_from_sec_url(fund_ticker):
-    load_dotenv()
-    email = os.getenv("USER_AGENT_EMAIL")
-
     # check if we have a url already but are just missing the nport
     url = db_utils.get_sec_url(fund_ticker)
     if url is None:
@@ -19,114 +115,314 @@ def fetch_nport_from_sec_url(fund_ticker):
         return None
 
     # Fetch the file
-    headers = {"User-Agent": f"PersonalInvestmentApp {email}"}
-    response = requests.get(url, headers=headers)
-    
+    response = fetch_with_retry(get_sec_session(), url)
+    if not response.ok:
+        print(f"Could not fetch N-PORT filing for {fund_ticker} (HTTP {response.status_code})")
+        return None
+
     return response.text
 
-def fetch_data_to_populate_companies(url):
-    load_dotenv()
-    email = os.getenv("USER_AGENT_EMAIL")
+# read N-PORT filings in chunks of this many bytes when streaming
+NPORT_CHUNK_SIZE = 64 * 1024
 
-    # Fetch the file
-    headers = {"User-Agent": f"PersonalInvestmentApp {email}"}
-    response = requests.get(url, headers=headers)
-    data = response.text
+# <genInfo> fields recorded in filing_info while a filing is parsed
+# repPdDate: the date the filing reports holdings as of (its report period, YYYY-MM-DD)
+# seriesLei: the LEI of the fund itself, which other funds list on their positions in it
+GENERAL_INFO_FIELDS = {"repPdDate": "report_period", "seriesLei": "series_lei"}
+
+# fields pulled out of each <invstOrSec> block, in holding row order
+# [ name, title, lei, cusip, pct_val, val_usd ]
+HOLDING_FIELDS = ("name", "title", "lei", "cusip", "pctVal", "valUSD")
+
+# drop the "{namespace}" prefix the XML parser puts on N-PORT tags
+def local_tag(tag):
+    return tag.rpartition("}")[2]
+
+# turn a finished <invstOrSec> element into a compact holding row, treating "N/A" as missing
+def holding_from_element(position):
+    fields = dict.fromkeys(HOLDING_FIELDS, "")
+    for child in position:
+        tag = local_tag(child.tag)
+        if tag in fields and child.text and child.text.strip() != "N/A":
+            fields[tag] = child.text.strip()
+
+    return (
+        fields["name"],
+        fields["title"],
+        fields["lei"],
+        fields["cusip"],
+        float(fields["pctVal"]) if fields["pctVal"] else None,
+        float(fields["valUSD"]) if fields["valUSD"] else None,
+    )
+
+# feed raw filing chunks through an incremental XML pull parser and yield one holding at a time
+# full .txt submissions wrap the XML in SGML headers, so only the text between <XML> and </XML> is parsed
+# each position is detached from the tree once read, so memory stays flat however large the filing is
+# pass a filing_info dict to have the filing's GENERAL_INFO_FIELDS ("report_period", "series_lei") recorded in it as it is read
+def iter_nport_holdings(chunks, filing_info=None):
+    parser = ET.XMLPullParser(events=("start", "end"))
+    open_elements = []
+    buffer = b""
+    in_xml = wrapped = started = False
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        buffer += chunk
+
+        if not in_xml:
+            stripped = buffer.lstrip()
+            if not wrapped and len(stripped) < len(b"<edgarSubmission"):
+                continue
+
+            # a bare XML document (e.g. primary_doc.xml) is parsed from its first byte
+            if not wrapped and stripped.startswith((b"<?xml", b"<edgarSubmission")):
+                in_xml = True
+            elif b"<XML>" in buffer:
+                buffer, in_xml = buffer.split(b"<XML>", 1)[1], True
+            else:
+                # keep enough of the tail to catch a marker split across chunks
+                wrapped = True
+                buffer = buffer[-len(b"<XML>"):]
+                continue
+
+        # the XML declaration has to be the very first thing the parser sees
+        if not started:
+            buffer = buffer.lstrip()
+            if not buffer:
+                continue
+            started = True
+
+        # stop at the end of the embedded XML document, holding back a possibly split closing marker
+        done = b"</XML>" in buffer
+        if done:
+            buffer = buffer.split(b"</XML>", 1)[0]
+            parser.feed(buffer)
+            buffer = b""
+        else:
+            parser.feed(buffer[:-len(b"</XML>")])
+            buffer = buffer[-len(b"</XML>"):]
+
+        yield from read_holding_events(parser, open_elements, filing_info)
+        if done:
+            break
 
-    # Check if we are looking at an NPORT doc
-    fund_investments = re.findall(r'<invstOrSec>.*?</invstOrSec>', data, re.DOTALL)
+    if in_xml:
+        parser.feed(buffer)
+        parser.close()
+        yield from read_holding_events(parser, open_elements, filing_info)
 
-    # Otherwise, we are looking at the company tickers JSON, so return it unfiltered
-    if fund_investments == []:
-        return data
+    return
 
+# drain the pull parser, yielding every <invstOrSec> that has been fully read
+def read_holding_events(parser, open_elements, filing_info=None):
+    for event, element in parser.read_events():
+        if event == "start":
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+        tag = local_tag(element.tag)
+        if tag in GENERAL_INFO_FIELDS and filing_info is not None and element.text and element.text.strip() != "N/A":
+            filing_info[GENERAL_INFO_FIELDS[tag]] = element.text.strip()
+        elif tag == "invstOrSec":
+            yield holding_from_element(element)
+            if open_elements:
+                open_elements[-1].remove(element)
+
+# parse a raw N-PORT filing once into compact holding rows
+# [ name, title, lei, cusip, pct_val, val_usd ]
+def parse_nport_holdings(nport_document, filing_info=None):
+    return list(iter_nport_holdings([nport_document], filing_info))
+
+# drain a stream of holdings (e.g. iter_response_holdings) into a list under the "parse" span and count them
+# the filing streams in as it is parsed, so the span covers the download of its body too
+def parse_holdings(holdings_iter):
+    with instrumentation_utils.span("parse"):
+        holdings = list(holdings_iter)
+    instrumentation_utils.increment("holdings_parsed", len(holdings))
+    return holdings
+
+# returned instead of holdings when the SEC answers a conditional request with 304 Not Modified
+NOT_MODIFIED = "not modified"
+
+# download and parse one filing
+# validators are the (etag, last_modified) stored from the last download, sent as a conditional request
+# returns NOT_MODIFIED, None if it could not be fetched or parsed, or
+# { "holdings": [ holdings ], "etag": ..., "last_modified": ..., "content_hash": sha256 of the raw filing, "document": zlib-compressed filing,
+#   "report_period": YYYY-MM-DD the holdings are reported as of, "series_lei": the fund's own LEI (None if the filing does not say) }
+def fetch_holdings_from_url(url, session, limiter=None, validators=None):
+    headers = {}
+    if validators is not None:
+        etag, last_modified = validators
+        if etag: headers["If-None-Match"] = etag
+        if last_modified: headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = fetch_with_retry(session, url, limiter, stream=True, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            return NOT_MODIFIED
+        if not response.ok:
+            print(f"Could not fetch N-PORT filing {url} (HTTP {response.status_code})")
+            response.close()
+            return None
+
+        # the raw filing is hashed and compressed as it streams past, so only the compressed copy is ever held
+        digest = hashlib.sha256()
+        compressor = zlib.compressobj(db_utils.FILING_COMPRESSION_LEVEL)
+        compressed = []
+        filing_info = {}
+        holdings = parse_holdings(iter_response_holdings(response, [digest.update, lambda chunk: compressed.append(compressor.compress(chunk))], filing_info))
+        compressed.append(compressor.flush())
+        return {
+            "holdings": holdings,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": digest.hexdigest(),
+            "document": b"".join(compressed),
+            "report_period": filing_info.get("report_period"),
+            "series_lei": filing_info.get("series_lei"),
+        }
+    except (requests.RequestException, ET.ParseError) as e:
+        print(f"Could not fetch N-PORT filing {url}: {e}")
+        return None
+
+# download and parse the filing of one fund on demand, over the shared SEC session and rate limit
+# returns None when there is no url for the fund or it could not be fetched, or the result of fetch_holdings_from_url
+def fetch_fund_filing(fund_ticker, existing_connection=None):
+    url = db_utils.get_sec_url(fund_ticker, existing_connection)
+    if url is None:
+        print(f"No SEC url to check for {fund_ticker}")
+        return None
+
+    result = fetch_holdings_from_url(url, get_sec_session())
+    if result is not None:
+        result["url"] = url
+    return result
+
+# fetch and parse many filings concurrently over one keep-alive session under the shared SEC rate limit
+# share classes pointing at the same filing (e.g. VTI/VTSAX) are only downloaded once
+# validators maps urls to the (etag, last_modified) to send as a conditional request
+# { url: result of fetch_holdings_from_url }
+def fetch_holdings_concurrently(urls, workers=REFRESH_WORKERS, session=None, limiter=None, validators=None):
+    if session is None:
+        session = get_sec_session()
+    if validators is None:
+        validators = {}
+
+    unique_urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_holdings_from_url, url, session, limiter, validators.get(url)) for url in unique_urls]
+        return {url: future.result() for url, future in zip(unique_urls, futures)}
+
+# hand raw chunks to each sink (e.g. a hash or a compressor) on their way to the parser
+def tee_chunks(chunks, sinks):
+    for chunk in chunks:
+        for sink in sinks:
+            sink(chunk)
+        yield chunk
+
+# sink counting the raw bytes of every filing streamed from the SEC
+def count_downloaded_bytes(chunk):
+    instrumentation_utils.increment("bytes_downloaded", len(chunk))
+
+# yield holdings from a streamed response and release the connection once they are consumed
+# sinks are called with every raw chunk of the filing as it streams past
+def iter_response_holdings(response, sinks=(), filing_info=None):
+    with response:
+        chunks = tee_chunks(response.iter_content(chunk_size=NPORT_CHUNK_SIZE), [*sinks, count_downloaded_bytes])
+        yield from iter_nport_holdings(chunks, filing_info)
+
+        # the parser stops at the end of the XML, but the sinks should see the whole filing
+        if sinks:
+            for chunk in chunks:
+                pass
+
+def fetch_data_to_populate_companies(url):
+    # Fetch the file
+    response = fetch_with_retry(get_sec_session(), url, stream=True)
+
+    # The company tickers JSON is small, so return it unfiltered
+    if url.endswith(".json"):
+        return response.text
+
+    # Otherwise we are looking at an NPORT doc, so stream its positions
     # [ name, title, lei, cusip ]
     all_funds = []
-    for fund_position in fund_investments:
-        this_fund = []
+    for name, title, lei, cusip, pct_val, val_usd in iter_response_holdings(response):
+        if not name: continue
+        all_funds.append([name, title, lei, cusip])
+
+    return all_funds
 
-        name = re.search(r'<name>(.*?)</name>', fund_position)
-        if name: 
-            if name.group(1) == 'N/A': continue
-            this_fund.append(name.group(1))
+# N-PORT filings whose holdings make up the companies table, merged in this order
+COMPANY_SOURCE_URLS = [
+    "https://www.sec.gov/Archives/edgar/data/819118/000003540225001329/0000035402-25-001329.txt", # Fidelity - FXAIX
+    "https://www.sec.gov/Archives/edgar/data/36405/000003640526000063/0000036405-26-000063.txt", # Vanguard - VFIAX
+]
 
-        title = re.search(r'<title>(.*?)</title>', fund_position)
-        if title: this_fund.append(title.group(1))
+# SEC-registered companies with tickers/CIKs
+COMPANY_TICKERS_URL = "https://www.sec.gov/files/company_tickers.json"
 
-        lei = re.search(r'<lei>(.*?)</lei>', fund_position)
-        if lei: this_fund.append(lei.group(1))
+# merge the company lists of any number of funds into one list of distinct companies
+# every company is resolved through hash indexes of the LEIs, CUSIPs and normalized names/titles seen so far,
+# so each lookup is O(1); a company seen again only fills in identifiers its first sighting was missing
+# [ name, title, lei, cusip ]
+def resolve_companies(fund_company_lists):
+    merged_companies = []
+    resolved = {}
 
-        cusip = re.search(r'<cusip>(.*?)</cusip>', fund_position)
-        if cusip: this_fund.append(cusip.group(1))
+    for fund_companies in fund_company_lists:
+        for name, title, lei, cusip in fund_companies:
+            keys = db_utils.holding_index_keys(name, title, lei, cusip, {})
+            company = next((resolved[key] for key in keys if key in resolved), None)
 
-        all_funds.append(this_fund)
+            if company is None:
+                company = [name, title, lei, cusip]
+                merged_companies.append(company)
+            else:
+                company[2] = company[2] or lei
+                company[3] = company[3] or cusip
 
-    return all_funds
+            for key in keys:
+                resolved.setdefault(key, company)
+
+    return merged_companies
+
+# append the SEC ticker and zero-padded CIK to every company whose name or title matches a registered company
+# the SEC titles are normalized into a hash index once instead of being re-sanitized for every company
+def link_company_tickers(companies, company_tickers):
+    tickers_by_title = {}
+    for item in company_tickers.values():
+        title = re.sub(r"\s*/NEW/", "", item["title"], flags=re.IGNORECASE)
+        tickers_by_title.setdefault(matching_utils.normalize_company_name(title), (item["ticker"], str(item["cik_str"]).zfill(10)))
+
+    match_count = 0
+    for company in companies:
+        for value in company[:2]:
+            link = tickers_by_title.get(matching_utils.normalize_company_name(value)) if value else None
+            if link:
+                company.extend(link)
+                match_count += 1
+                break
+
+    return match_count
+
+def fetch_company_data(urls=None):
+        if urls is None:
+            urls = COMPANY_SOURCE_URLS
+
+        # Load fund composition data and merge the funds into one list of distinct companies
+        # These lists should be almost identical when the funds track the same index (e.g. the S&P 500)
+        merged_companies = resolve_companies(fetch_data_to_populate_companies(url) for url in urls)
 
-def fetch_company_data():
-        # Vanguard - VFIAX
-        url_vanguard = "https://www.sec.gov/Archives/edgar/data/36405/000003640526000063/0000036405-26-000063.txt"
-
-        # Fidelity - FXAIX
-        url_fidelity = "https://www.sec.gov/Archives/edgar/data/819118/000003540225001329/0000035402-25-001329.txt"
-
-        # SEC-registered companies with tickers/CIKs
-        url_companies = "https://www.sec.gov/files/company_tickers.json"
-
-        # Load fund composition data
-        all_vanguard_fund_companies = fetch_data_to_populate_companies(url_vanguard)
-        all_fidelity_fund_companies = fetch_data_to_populate_companies(url_fidelity)
-
-        # Start with list of companies in fidelity fund and merge in new values from vanguard's fund
-        # These lists should be almost identical (they are both tracking the S&P 500)
-        if all_fidelity_fund_companies:
-            merged_companies = list(all_fidelity_fund_companies).copy()
-            if all_vanguard_fund_companies:
-                for v_fund in all_vanguard_fund_companies:
-                    overlap_flag = False
-                    for f_fund in all_fidelity_fund_companies:
-                        # Match names/titles to each other or leis
-                        if (v_fund[0].casefold() == f_fund[0].casefold() or
-                            v_fund[0].casefold() == f_fund[1].casefold() or
-                            v_fund[1].casefold() == f_fund[1].casefold() or
-                            v_fund[1].casefold() == f_fund[0].casefold() or
-                            (len(v_fund) > 2 and len(f_fund) > 2) or v_fund[3] == f_fund[3] ): 
-                                overlap_flag = True
-                                break
-                    # Found a company in the Vanguard fund that was not in the Fidelity fund
-                    if not overlap_flag:
-                        merged_companies.append(v_fund)
-        else: 
-            merged_companies = list(all_vanguard_fund_companies).copy()
-
-        print(f"Found {len(merged_companies)} companies within Vanguard/Fidelity S&P500 funds\n")
-        # filter out "N/A" values - use empty string "" instead
-        merged_companies = [["" if item == "N/A" else item for item in row] for row in merged_companies]
+        print(f"Found {len(merged_companies)} companies within {len(urls)} funds\n")
 
         # Scrape a large list of SEC-registered companies and their tickers/CIK values and parse into JSON
-        company_scraped_data = fetch_data_to_populate_companies(url_companies)
-        if company_scraped_data:
-            all_companies = json.loads(str(company_scraped_data))
-
-            match_count = 0
-            for company in merged_companies:
-                # sanitize name and title for the sake of matching
-                name = company[0]
-                name = re.sub(r"[.,]|\b(inc|corp|corporation|ltd|llc)\b", "", name)
-                title = company[1]
-                title = re.sub(r"[.,]|\b(inc|corp|corporation|ltd|llc)\b", "", title)
-
-                for item in all_companies.values():
-                    all_search = item["title"]
-                    # sanitize company title and then compare to names/titles from fund filings
-                    all_search = re.sub(r"[.,]| /NEW/", "", all_search)
-                    if name.casefold() == all_search.casefold() or title.casefold() == all_search.casefold():
-                        match_count += 1
-                        company.append(item["ticker"])
-                        # prepend zeroes to pad to length 10 for all 
-                        company.append(str(item["cik_str"]).zfill(10))
-                        break
-            
+        company_scraped_data = fetch_data_to_populate_companies(COMPANY_TICKERS_URL)
+        if company_scraped_data and merged_companies:
+            match_count = link_company_tickers(merged_companies, json.loads(str(company_scraped_data)))
             print(f"Successfully linked {match_count} company tickers and CIKs ({int(match_count/len(merged_companies)*100)}%) to representations in funds\n")
 
         else:
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db_utils
+import finance_utils
+import instrumentation_utils
+import matrix_utils
+import service_client
+
+# resident exposure service: parsed holdings (db_utils.HOLDINGS_CACHE) and the companies table (db_utils.COMPANY_IDENTIFIERS)
+# are loaded once and stay warm between queries, which are answered over newline-delimited JSON-RPC 2.0 (see service_client.call)
+
+# threads running queries, each keeps its own persistent database connection (db_utils.get_connection)
+SERVICE_WORKERS = 4
+
+# longest request line the service reads
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+STARTED_AT = time.monotonic()
+
+# load every parsed fund's holdings and the companies table into memory
+# called when the service starts and through the "reload" method (e.g. after python cli.py refresh in another process)
+# { "funds": funds warmed, "company_identifiers": identifiers held }
+def warm_caches(existing_connection=None):
+    conn = db_utils.get_connection(existing_connection)
+
+    identifiers = db_utils.hold_company_identifiers(conn)
+    db_utils.prune_exposure_results(conn)
+    # the service's connection must not keep the write lock other processes (refresh, imports) need
+    conn.commit()
+    funds = [fund for fund, parsed in db_utils.load_parsed_funds(None, conn).items() if parsed]
+    warmed = len(db_utils.load_fund_holdings(funds, conn)) if funds else 0
+
+    print(f"Warmed holdings of {warmed} fund(s) and {identifiers} company identifier(s)")
+    return {"funds": warmed, "company_identifiers": identifiers}
+
+# cache footprints and hit rates plus the spans and counters measured since the service started
+def service_stats():
+    measurements = instrumentation_utils.snapshot()
+    return {
+        "uptime_seconds": time.monotonic() - STARTED_AT,
+        "holdings_cache": db_utils.HOLDINGS_CACHE.stats(),
+        "company_identifiers": len(db_utils.COMPANY_IDENTIFIERS or {}),
+        "spans": measurements["spans"],
+        "counters": measurements["counters"],
+    }
+
+# methods callable by clients
+METHODS = {
+    "ping": lambda: "pong",
+    "portfolio": lambda user_id: db_utils.load_user_portfolio(user_id),
+    "exposures": lambda user_id, companies, engine="index": finance_utils.compute_exposures(user_id, companies, engine=engine),
+    "exposures_all": lambda user_id, top_n=None: matrix_utils.calculate_all_exposures(user_id, top_n),
+    "exposure_history": lambda user_id, companies, start=None, end=None: matrix_utils.calculate_exposure_history(user_id, companies, start, end),
+    "stats": service_stats,
+    "reload": warm_caches,
+}
+
+# checks of parameter values, each is (test, description for the error message)
+INTEGER = (lambda value: isinstance(value, int) and not isinstance(value, bool), "an integer")
+OPTIONAL_INTEGER = (lambda value: value is None or INTEGER[0](value), "an integer or null")
+COMPANY_LIST = (lambda value: isinstance(value, list) and all(isinstance(company, str) and company.strip() for company in value), "a list of company names or identifiers")
+ENGINE = (lambda value: value in finance_utils.ENGINES, f"one of {', '.join(finance_utils.ENGINES)}")
+OPTIONAL_DATE = (lambda value: value is None or (isinstance(value, str) and re.fullmatch(r"\d{4}-\d{2}-\d{2}", value) is not None), "a YYYY-MM-DD date or null")
+
+# parameters of each method in positional order: (name, check, required)
+METHOD_PARAMS = {
+    "ping": [],
+    "portfolio": [("user_id", INTEGER, True)],
+    "exposures": [("user_id", INTEGER, True), ("companies", COMPANY_LIST, True), ("engine", ENGINE, False)],
+    "exposures_all": [("user_id", INTEGER, True), ("top_n", OPTIONAL_INTEGER, False)],
+    "exposure_history": [("user_id", INTEGER, True), ("companies", COMPANY_LIST, True), ("start", OPTIONAL_DATE, False), ("end", OPTIONAL_DATE, False)],
+    "stats": [],
+    "reload": [],
+}
+
+# match a request's params (positional list or keyword object) against METHOD_PARAMS before the method runs
+# returns the keyword arguments to call the method with, raises ValueError describing the first problem
+def check_params(method, params):
+    spec = METHOD_PARAMS[method]
+    names = [name for name, check, required in spec]
+
+    if isinstance(params, list):
+        if len(params) > len(spec):
+            raise ValueError(f"{method} takes at most {len(spec)} params")
+        arguments = dict(zip(names, params))
+    elif isinstance(params, dict):
+        unknown = set(params) - set(names)
+        if unknown:
+            raise ValueError(f"unknown params for {method}: {', '.join(sorted(unknown))}")
+        arguments = dict(params)
+    else:
+        raise ValueError("params must be a list or an object")
+
+    for name, (test, description), required in spec:
+        if name not in arguments:
+            if required:
+                raise ValueError(f"missing param {name}")
+        elif not test(arguments[name]):
+            raise ValueError(f"{name} must be {description}")
+
+    return arguments
+
+def error_response(request_id, code, message):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+# answer one request line (runs on a worker thread)
+def handle_request(line):
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return error_response(None, PARSE_ERROR, "request is not valid JSON")
+
+    if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+        return error_response(None, INVALID_REQUEST, "request must be an object with a method")
+
+    request_id = request.get("id")
+    method = METHODS.get(request["method"])
+    if method is None:
+        return error_response(request_id, METHOD_NOT_FOUND, f"unknown method {request['method']}")
+
+    try:
+        arguments = check_params(request["method"], request.get("params", []))
+    except ValueError as e:
+        return error_response(request_id, INVALID_PARAMS, str(e))
+
+    # params are checked, so anything raised from here on is the service's failure
+    try:
+        with instrumentation_utils.span(f"service.{request['method']}"):
+            result = method(**arguments)
+    except Exception as e:
+        return error_response(request_id, SERVER_ERROR, f"{type(e).__name__}: {e}")
+
+    return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+# serve the requests of one client connection in order until it disconnects
+async def handle_connection(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                writer.write(json.dumps(error_response(None, INVALID_REQUEST, "request is too long")).encode() + b"\n")
+                break
+            if not line:
+                break
+
+            response = await loop.run_in_executor(executor, handle_request, line)
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+    return
+
+# warm the caches, then answer clients until interrupted
+async def serve(host=service_client.SERVICE_HOST, port=service_client.SERVICE_PORT, workers=SERVICE_WORKERS):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, warm_caches)
+
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_connection(reader, writer, executor), host, port, limit=MAX_REQUEST_BYTES
+        )
+        print(f"Exposure service listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+def main(host=service_client.SERVICE_HOST, port=service_client.SERVICE_PORT):
+    asyncio.run(serve(host, port))
@@ -1,121 +1,306 @@
-import re
+import hashlib
+import json
 import db_utils
-import data_scraping_utils
-import time
-from threading import Thread, Lock
+import matching_utils
+import instrumentation_utils
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Declare class variables
-# static globals
+# static globals (only read by determine_portfolio_exposure, compute_exposures takes everything as arguments)
 USER = 1
-START_TIME = END_TIME = None
-# FUNDS should be a dictionary with the fund ticker and the nport
-FUNDS = {}
 
-LOCK = Lock()
+# ways exposures can be calculated (see calculate_fund_weights)
+ENGINES = ("index", "thread", "process", "search")
+
+# worker processes used by the "process" engine (None --> one per CPU)
+EXPOSURE_PROCESSES = None
 
 COMPANIES_TO_SEARCH_KEYS = ["Amazon.com Inc", "Another NA Company", "Netflix", "NA-Company!"]
 COMPANIES_TO_SEARCH = dict.fromkeys(COMPANIES_TO_SEARCH_KEYS, 0.0)
 
-# manage program timer
-def timer():
-    global START_TIME, END_TIME
-    if START_TIME is None:
-        START_TIME = time.perf_counter()
-    else:
-        END_TIME = time.perf_counter()
-        elapsed_time = END_TIME - START_TIME
-        print(f"\nExecution time: {elapsed_time:.4f} seconds\n")
-    return
+# nicely print results (COMPANIES_TO_SEARCH unless other exposures are given)
+def print_exposures(exposures=None):
+    if exposures is None:
+        exposures = COMPANIES_TO_SEARCH
 
-# nicely print results
-def print_exposures():
     print("\n\n---------------------------------------")
     print("| Companies with Calculated Exposures |")
     print("---------------------------------------")
-    for company, amount in COMPANIES_TO_SEARCH.items():
+    for company, amount in exposures.items():
         print(f"{company} --> {"no exposure found" if amount == 0.0 else f"${amount}"}")
     print("---------------------------------------")
     return
 
-# use fund report filing to determine percentage weights of various company holdings and update cumulative portfolio table
-def calculate_company_exposures_for_fund(fund, num_shares):
+# fetch a fund's filing once, store it the way refresh does (filing, validators, holdings and index, filing history, series LEI)
+# and return its holdings
+def fetch_missing_holdings(fund, db_connection=None):
+    # the network stack (requests, dotenv) is only imported once a filing has to be downloaded
+    import data_scraping_utils
+
+    result = data_scraping_utils.fetch_fund_filing(fund, db_connection)
+    if result is None:
+        print(f"Could not find an N-PORT filing for fund: {fund}. It will not be calculated in the results")
+        return None
+
+    print(f"updating cached holdings for database entry of fund {fund}")
+    db_utils.store_fetched_filing(fund, result["url"], result, db_connection)
+    return result["holdings"]
+
+# flatten [ (fund, shares) ] positions into { fund: cumulative shares }, consolidating repeated funds
+def flatten_portfolio(portfolio):
+    portfolio_flattened = {}
+    for fund, num_shares in portfolio:
+        portfolio_flattened[fund] = portfolio_flattened.get(fund, 0) + num_shares
+    return portfolio_flattened
+
+# load the parsed holdings of each fund, fetching filings that have not been parsed yet
+# funds missing from the database (or without a filing) are left out
+# { fund: holdings }
+def load_holdings(funds, db_connection):
     # 0 --> no key was found in database
-    # None --> key found in database but no or stale nport_document value
-    # Value --> nport_document exists
-    nport = FUNDS.get(fund, 0)
-    match nport:
-        case 0:
-            print(f"Fund not found in database: {fund}")
-            return
-        case None:
-            nport = data_scraping_utils.fetch_nport_from_sec_url(fund)
-            if nport is None:
-                print(f"Could not find an N-PORT filing for fund: {fund}. It will not be calculated in the results")
-                return
+    # None --> key found in database but the filing has not been parsed into holdings yet
+    # Value --> parsed holdings exist
+    fund_holdings = db_utils.load_fund_holdings(funds, db_connection)
+    for fund in funds:
+        match fund_holdings.get(fund, 0):
+            case 0:
+                print(f"Fund not found in database: {fund}")
+            case None:
+                fund_holdings[fund] = fetch_missing_holdings(fund, db_connection)
+
+    return {fund: holdings for fund, holdings in fund_holdings.items() if holdings is not None}
+
+# match one fund's holdings against the companies to search and return that fund's partial exposures
+# holdings match by exact identifier or normalized name through a hashed key -> companies map, so "Meta" never matches "Metals"
+# companies_to_search is { company: [ keys ] } (see db_utils.resolve_company_keys) or a plain list of names/identifiers
+# only depends on its arguments, so it can run in a worker process as well as a thread
+# { company: amount }
+def scan_fund_holdings(holdings, num_shares, companies_to_search):
+    if not isinstance(companies_to_search, dict):
+        companies_to_search = {company: db_utils.company_query_keys(company) for company in companies_to_search}
+
+    companies_by_key = {}
+    for company, keys in companies_to_search.items():
+        for key in keys:
+            companies_by_key.setdefault(key, []).append(company)
+
+    exposures = {}
+    for name, title, lei, cusip, pct_val, val_usd in holdings:
+        if pct_val is None:
+            continue
+
+        # a holding found under several keys (e.g. both its name and its LEI) is only counted once per company
+        matched = set()
+        for key in db_utils.holding_index_keys(name, title, lei, cusip, {}):
+            matched.update(companies_by_key.get(key, ()))
+
+        for company in matched:
+            exposures[company] = exposures.get(company, 0.0) + pct_val * num_shares
+
+    return exposures
+
+# free-text name search of one fund's holdings, each name and title is scanned once by the matcher whatever the number of companies
+# { company: amount }
+def search_fund_holdings(holdings, num_shares, matcher):
+    exposures = {}
+    for name, title, lei, cusip, pct_val, val_usd in holdings:
+        if pct_val is None:
+            continue
+
+        matched = matcher.matches(name)
+        if title != name:
+            matched |= matcher.matches(title)
+
+        for company in matched:
+            exposures[company] = exposures.get(company, 0.0) + pct_val * num_shares
+
+    return exposures
+
+# look up the weight of each company in each fund through the inverted exposure index
+# costs one indexed lookup per company asked about instead of a scan of every position of every fund
+# { fund: { company: pct_val } }
+def indexed_fund_weights(funds, companies, db_connection):
+    # None --> no key was found in database
+    # False --> key found in database but the filing has not been parsed (and indexed) yet
+    parsed_funds = db_utils.load_parsed_funds(funds, db_connection)
+    indexed_funds = []
+    for fund in funds:
+        match parsed_funds.get(fund):
+            case None:
+                print(f"Fund not found in database: {fund}")
+                continue
+            case False:
+                if fetch_missing_holdings(fund, db_connection) is None:
+                    continue
+        indexed_funds.append(fund)
+
+    if not indexed_funds:
+        return {}
+
+    fund_weights = {fund: {} for fund in indexed_funds}
+    for company, weights in db_utils.lookup_company_exposures(companies, indexed_funds, db_connection).items():
+        for fund, pct_val in weights.items():
+            fund_weights[fund][company] = pct_val
+
+    return fund_weights
+
+# weight of each company in each fund (pct_val summed over the matching positions)
+# engine "index" looks weights up in the inverted exposure index
+# engine "thread" scans every position of every fund against hashed company keys, one thread per fund
+# engine "process" does the same scan in a pool of worker processes (CPU-bound matching is not serialized by the GIL)
+# engine "search" is a free-text name search, every position whose name contains a company's name as whole words matches
+# { fund: { company: pct_val } }
+@instrumentation_utils.span("match")
+def calculate_fund_weights(funds, companies, db_connection, engine="index"):
+    if engine == "index":
+        return indexed_fund_weights(funds, companies, db_connection)
+
+    fund_holdings = load_holdings(funds, db_connection)
+    if not fund_holdings:
+        return {}
+
+    # counted here rather than in the scans, whose counters would be lost in worker processes
+    instrumentation_utils.increment("positions_scanned", sum(len(holdings) for holdings in fund_holdings.values()))
+
+    if engine == "process":
+        executor = ProcessPoolExecutor(max_workers=EXPOSURE_PROCESSES)
+    else:
+        executor = ThreadPoolExecutor(max_workers=len(fund_holdings))
+
+    # the matcher for the query set is built once and shared by every fund
+    if engine == "search":
+        scan, matcher = search_fund_holdings, matching_utils.NameMatcher(companies)
+    else:
+        scan, matcher = scan_fund_holdings, db_utils.resolve_company_keys(companies, db_connection)
+
+    with executor:
+        futures = {fund: executor.submit(scan, holdings, 1, matcher) for fund, holdings in fund_holdings.items()}
+        return {fund: future.result() for fund, future in futures.items()}
+
+# combine a flattened portfolio with per-fund company weights into { company: amount } rounded to cents
+def apply_fund_weights(portfolio, fund_weights, companies):
+    exposures = dict.fromkeys(companies, 0.0)
+    for fund, num_shares in portfolio.items():
+        for company, pct_val in fund_weights.get(fund, {}).items():
+            exposures[company] += pct_val * num_shares
+
+    return {company: round(amount, 2) for company, amount in exposures.items()}
+
+# children-first order of every fund reachable from funds through fund-in-fund links (see db_utils.load_fund_links)
+# a link that would close a cycle is dropped (and reported), so every fund is expanded exactly once however deep the graph
+# returns [ funds in expansion order ], { fund: [ (held fund, pct_val), ... ] } without the cycle links
+def look_through_order(funds, fund_links):
+    order, links, state = [], {}, {}
+
+    for root in funds:
+        if root in state:
+            continue
+        state[root], links[root] = "visiting", []
+        stack = [(root, iter(fund_links.get(root, ())))]
+
+        # iterative depth-first search, a fund is finished once all the funds it holds are
+        while stack:
+            fund, held = stack[-1]
+            for held_fund, pct_val in held:
+                if state.get(held_fund) == "visiting":
+                    print(f"Fund cycle: {fund} holds {held_fund}, which already holds {fund}. That position is not looked through")
+                    continue
+                links[fund].append((held_fund, pct_val))
+                if held_fund not in state:
+                    state[held_fund], links[held_fund] = "visiting", []
+                    stack.append((held_fund, iter(fund_links.get(held_fund, ()))))
+                    break
             else:
-                # update the existing record because we fetched a new document
-                print(f"updating cached nport document for database entry of fund {fund}")
-                db_utils.update_existing_fund(fund, None, nport)
-        case _:
-            print(f"Using cached nport document for fund {fund}!")
-             
-    # Parse all holdings of the fund into iterable sections
-    fund_investments = re.findall(r'<invstOrSec>.*?</invstOrSec>', nport, re.DOTALL)
-
-    # loop through all fund_positions and check for each companie to search
-    for fund_position in fund_investments:
-        for company in COMPANIES_TO_SEARCH_KEYS:
-            # [MVP]: search for just the "name" (ex: "Amazon.com Inc) within the report filing
-            name_match = re.search(re.escape(company), fund_position, re.IGNORECASE)
-        
-            # Get percentage weight if holding for company is found
-            if name_match:
-                holding_percentage = re.search(r'<pctVal>(.*?)</pctVal>', fund_position)
-
-                # Determine user value of certain holding (NAV * num shares held) and holding of lookup stock (weight % of lookup * num shares held)
-                if holding_percentage:
-                    company_holding_amount = float(holding_percentage.group(1)) * num_shares
-                    with LOCK:
-                        print(f"Holding ${company_holding_amount} of {company} in {fund}")
-                        COMPANIES_TO_SEARCH[company] = COMPANIES_TO_SEARCH.get(company, 0.0) + company_holding_amount
-        
-    return
+                stack.pop()
+                state[fund] = "done"
+                order.append(fund)
 
+    return order, links
 
-def determine_portfolio_exposure():
-    timer()
-    global FUNDS, COMPANIES_TO_SEARCH
+# add to each fund's own company weights those of the funds it holds, scaled by the position's pct_val (a percentage)
+# funds are expanded in look_through_order, so each expanded vector is computed once and reused by every fund holding it
+# { fund: { company: pct_val } }
+def expand_fund_weights(order, links, fund_weights):
+    expanded = {}
+    for fund in order:
+        weights = dict(fund_weights.get(fund, {}))
+        for held_fund, pct_val in links[fund]:
+            for company, held_pct_val in expanded[held_fund].items():
+                weights[company] = weights.get(company, 0.0) + pct_val / 100 * held_pct_val
+        expanded[fund] = weights
 
-    db_connection = db_utils.connect()
+    return expanded
 
-    PORTFOLIO = db_utils.load_user_portfolio(USER, db_connection)
-    PORTFOLIO_FLATTENED = {}
+# calculate_fund_weights, looking through positions in other funds of the database
+# { fund: { company: pct_val } }
+def look_through_fund_weights(funds, companies, db_connection, engine="index"):
+    order, links = look_through_order(funds, db_utils.load_fund_links(db_connection))
+    return expand_fund_weights(order, links, calculate_fund_weights(order, companies, db_connection, engine))
 
-    # flatten portfolio into dictionary of unique funds (consolidated) and cumulative number of shares held of each
-    for fund, num_shares in PORTFOLIO:
-        PORTFOLIO_FLATTENED[fund] = PORTFOLIO_FLATTENED.get(fund, 0) + num_shares
+# key of a memoized exposure result: the flattened portfolio, the holdings version of every fund it reaches, the companies and the engine
+# (engines can disagree, "search" matches names inside names where the others match whole names and identifiers)
+def exposure_cache_key(portfolio, holdings_versions, companies, engine):
+    key = json.dumps([sorted(portfolio.items()), sorted(holdings_versions.items()), sorted(set(companies)), engine])
+    return hashlib.sha256(key.encode()).hexdigest()
 
-    print(f"(User {USER}) flattened portfolio to calculate exposures for: {PORTFOLIO_FLATTENED}")
-    print(f"Companies to check exposures to: {COMPANIES_TO_SEARCH_KEYS}\n")
+# calculate a user's exposure to each company without touching any module state
+# { company: amount }
+@instrumentation_utils.span("compute_exposures")
+def compute_exposures(user_id, companies, conn=None, engine="index"):
+    db_connection = db_utils.get_connection(conn)
 
-    FUNDS = db_utils.load_funds_from_cache(list(PORTFOLIO_FLATTENED.keys()), db_connection)
+    portfolio = flatten_portfolio(db_utils.load_user_portfolio(user_id, db_connection))
+    order, links = look_through_order(list(portfolio.keys()), db_utils.load_fund_links(db_connection))
 
-    # loop through dictionary of positions and lookup each COMPANY_TO_SEARCH dictionary value into that fund and update cumulative total holding
-    # for searching, use legal name for now, but can also use: LEI, ISIN, FIGI
-    threads = []
-    for fund, num_shares in PORTFOLIO_FLATTENED.items():
-        t = Thread(target=calculate_company_exposures_for_fund, args=(fund, num_shares))
-        t.start()
-        threads.append(t)
+    # identical portfolios asking about the same companies share one memoized result until the holdings of a fund they reach change
+    cache_key = exposure_cache_key(portfolio, db_utils.load_holdings_versions(order, db_connection), companies, engine)
+    exposures = db_utils.load_exposure_result(cache_key, db_connection)
+    if exposures is not None:
+        instrumentation_utils.increment("exposure_results_hits")
+        return {company: exposures[company] for company in companies}
+    instrumentation_utils.increment("exposure_results_misses")
 
-    [t.join() for t in threads]
+    fund_weights = calculate_fund_weights(order, companies, db_connection, engine)
+    with instrumentation_utils.span("aggregate"):
+        exposures = apply_fund_weights(portfolio, expand_fund_weights(order, links, fund_weights), companies)
 
-    # round values in place within dictionary to cents
-    COMPANIES_TO_SEARCH = {holding: round(amount, 2) for holding, amount in COMPANIES_TO_SEARCH.items()}
-    print_exposures()
+    # a result missing a fund whose filing could not be fetched is not memoized, so the next call retries the fetch
+    # holdings outside the funds table (single stocks, unknown tickers) are memoized: adding the fund later changes the holdings versions
+    # versions are read again since fetching a filing bumps its fund's version
+    parsed_funds = db_utils.load_parsed_funds(order, db_connection)
+    if all(parsed_funds.get(fund) is not False for fund in order):
+        cache_key = exposure_cache_key(portfolio, db_utils.load_holdings_versions(order, db_connection), companies, engine)
+        db_utils.store_exposure_result(cache_key, order, exposures, conn)
 
-    db_connection.close()
-    timer()
-    
-    return
+    return exposures
+
+# calculate the exposures of many users at once
+# every fund held by any of the users is loaded and matched once, then shared across all of their portfolios
+# { user: { company: amount } }
+@instrumentation_utils.span("compute_exposures_many")
+def compute_exposures_many(user_ids, companies, conn=None, engine="index"):
+    db_connection = db_utils.get_connection(conn)
+
+    portfolios = {user: {} for user in user_ids}
+    for user, fund, amount in db_utils.load_portfolios(list(user_ids), db_connection):
+        portfolios[user][fund] = amount
+
+    funds = list(dict.fromkeys(fund for portfolio in portfolios.values() for fund in portfolio))
+    fund_weights = look_through_fund_weights(funds, companies, db_connection, engine)
+
+    with instrumentation_utils.span("aggregate"):
+        return {user: apply_fund_weights(portfolio, fund_weights, companies) for user, portfolio in portfolios.items()}
 
+# calculate and print the exposures of USER to COMPANIES_TO_SEARCH_KEYS, keeping the result in COMPANIES_TO_SEARCH
+def determine_portfolio_exposure(engine="index"):
+    global COMPANIES_TO_SEARCH
+
+    with instrumentation_utils.span("determine_portfolio_exposure") as timing:
+        print(f"(User {USER}) companies to check exposures to: {COMPANIES_TO_SEARCH_KEYS}\n")
+
+        COMPANIES_TO_SEARCH = compute_exposures(USER, COMPANIES_TO_SEARCH_KEYS, engine=engine)
+        print_exposures()
+
+    print(f"\nExecution time: {timing.elapsed:.4f} seconds\n")
+
+    return
@@ -0,0 +1,177 @@
+import functools
+import io
+import json
+import re
+import threading
+import time
+
+# prefix of every exported Prometheus metric
+METRIC_PREFIX = "investment_dashboard"
+
+# spans run under cProfile (e.g. {"compute_exposures"}), empty --> profiling off
+# only one profiler can be active per interpreter, so a profiled span nested in (or concurrent with) another one is only timed
+PROFILED_SPANS = set()
+
+# lines of cProfile output kept per profiled span, sorted by cumulative time
+PROFILE_LINES = 30
+
+# collected measurements, shared by every thread
+SPANS = {} # span path --> [ calls, total seconds, max seconds ]
+COUNTERS = {} # counter --> total
+PROFILES = {} # span path --> cProfile report of its last profiled run
+LOCK = threading.Lock()
+
+# per-thread stack of the paths of the spans currently open ("compute_exposures/match")
+ACTIVE_SPANS = threading.local()
+
+# a timed section of code, used as a context manager (with span("match"): ...) or a decorator (@span("db.load_portfolios"))
+# spans opened inside another one on the same thread are recorded under its path, e.g. "compute_exposures/match"
+# elapsed holds the wall-clock seconds of the last run once it has finished
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+        self.elapsed = None
+        self.profiler = None
+        self.start = None
+
+    def __enter__(self):
+        stack = active_spans()
+        self.path = f"{stack[-1]}/{self.name}" if stack else self.name
+        stack.append(self.path)
+
+        if self.name in PROFILED_SPANS:
+            self.profiler = start_profiler()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        active_spans().pop()
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            record_profile(self.path, self.profiler)
+            self.profiler = None
+
+        record_span(self.path, self.elapsed)
+        return False
+
+    # as a decorator every call gets its own span, so decorated functions stay safe to call from many threads
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(self.name):
+                return function(*args, **kwargs)
+        return wrapper
+
+def span(name):
+    return Span(name)
+
+# this thread's stack of open span paths
+def active_spans():
+    stack = getattr(ACTIVE_SPANS, "stack", None)
+    if stack is None:
+        stack = ACTIVE_SPANS.stack = []
+    return stack
+
+# path of the innermost span open on this thread, None outside of any span
+def current_span():
+    stack = active_spans()
+    return stack[-1] if stack else None
+
+def record_span(path, elapsed):
+    with LOCK:
+        timing = SPANS.get(path)
+        if timing is None:
+            SPANS[path] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+    return
+
+# add amount to a counter (bytes downloaded, positions scanned, cache hits, ...)
+def increment(counter, amount=1):
+    with LOCK:
+        COUNTERS[counter] = COUNTERS.get(counter, 0) + amount
+    return
+
+# an enabled profiler, or None when another one is already running
+# cProfile and pstats are only imported once a span is profiled, they are not part of every command's startup
+def start_profiler():
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+def record_profile(path, profiler):
+    import pstats
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    with LOCK:
+        PROFILES[path] = report.getvalue()
+    return
+
+# forget everything measured so far
+def reset():
+    with LOCK:
+        SPANS.clear()
+        COUNTERS.clear()
+        PROFILES.clear()
+    return
+
+# copy of everything measured so far
+# { "spans": { path: { "calls", "total_seconds", "max_seconds" } }, "counters": { counter: total }, "profiles": { path: report } }
+def snapshot():
+    with LOCK:
+        return {
+            "spans": {
+                path: {"calls": calls, "total_seconds": total, "max_seconds": longest}
+                for path, (calls, total, longest) in sorted(SPANS.items())
+            },
+            "counters": dict(sorted(COUNTERS.items())),
+            "profiles": dict(PROFILES),
+        }
+
+def export_json():
+    return json.dumps(snapshot(), indent=2)
+
+# escape a Prometheus label value
+def label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Prometheus text exposition format (cProfile reports are only part of the JSON export)
+def export_prometheus():
+    measurements = snapshot()
+    lines = []
+
+    span_metrics = (
+        ("span_calls_total", "counter", "Times each instrumented span ran.", "calls"),
+        ("span_seconds_total", "counter", "Wall-clock seconds spent in each instrumented span.", "total_seconds"),
+        ("span_max_seconds", "gauge", "Longest single run of each instrumented span.", "max_seconds"),
+    )
+    for metric, metric_type, help_text, field in span_metrics:
+        lines.append(f"# HELP {METRIC_PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{metric} {metric_type}")
+        for path, timing in measurements["spans"].items():
+            lines.append(f"{METRIC_PREFIX}_{metric}{{span=\"{label_value(path)}\"}} {timing[field]}")
+
+    for counter, total in measurements["counters"].items():
+        metric = f"{METRIC_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', counter)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {total}")
+
+    return "\n".join(lines) + "\n"
+
+# the cProfile reports of every profiled span as plain text, one section per span path
+def export_profiles():
+    profiles = snapshot()["profiles"]
+    if not profiles:
+        return "No profiled span ran (another profiler may have been active)\n"
+    return "".join(f"cProfile report of {path}\n{report}\n" for path, report in sorted(profiles.items()))
@@ -0,0 +1,67 @@
+import re
+
+# sanitize a company name or title for matching: case, punctuation and corporate suffixes are ignored
+def normalize_company_name(name):
+    name = re.sub(r"\b(inc|corp|corporation|ltd|llc)\b", "", re.sub(r"[.,]", " ", name.casefold()))
+    return " ".join(name.split())
+
+# Aho-Corasick automaton over the normalized names of a set of company queries
+# built once per query set, then every holding name is scanned a single time whatever the number of companies asked about
+# a company matches a name when its normalized query occurs in the normalized name as whole words ("meta" never matches "metals")
+class NameMatcher:
+    def __init__(self, companies):
+        self.transitions = [{}] # state --> { character: state }
+        self.outputs = [[]] # state --> [ (pattern length, company), ... ] ending at that state
+        self.fail = [0]
+
+        for company in companies:
+            pattern = normalize_company_name(company)
+            if pattern:
+                self.add_pattern(pattern, company)
+        self.link_failures()
+
+    # add one normalized pattern to the trie
+    def add_pattern(self, pattern, company):
+        state = 0
+        for character in pattern:
+            next_state = self.transitions[state].get(character)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions[state][character] = next_state
+                self.transitions.append({})
+                self.outputs.append([])
+                self.fail.append(0)
+            state = next_state
+        self.outputs[state].append((len(pattern), company))
+        return
+
+    # breadth-first pass setting each state's failure link to its longest proper suffix in the trie
+    # outputs of the suffix state are merged in, so overlapping matches ("amazon" inside "amazon com") are all reported
+    def link_failures(self):
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for character, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and character not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(character, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+        return
+
+    # set of companies whose query occurs in the name as whole words
+    def matches(self, name):
+        text = normalize_company_name(name)
+        found = set()
+        state = 0
+        for end, character in enumerate(text):
+            while state and character not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(character, 0)
+
+            for length, company in self.outputs[state]:
+                start = end - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end + 1 == len(text) or not text[end + 1].isalnum()):
+                    found.add(company)
+
+        return found
@@ -0,0 +1,326 @@
+import os
+import shutil
+import time
+import numpy as np
+import db_utils
+import finance_utils
+import matching_utils
+import instrumentation_utils
+
+# number of users whose exposure vectors are computed in one matrix-matrix product
+USER_BLOCK_SIZE = 256
+
+# directory of the columnar holdings cache, one sub-directory of .npy files per filing (None --> cache disabled)
+HOLDINGS_CACHE_DIR = "holdings_cache"
+
+# columns of a cached filing
+# pct_val / val_usd: float64 per holding (NaN where missing)
+# key_codes: int32 per holding, dictionary code of its company column key
+# keys / labels: the dictionary (distinct company column keys and the display label of each)
+HOLDINGS_CACHE_COLUMNS = ("pct_val", "val_usd", "key_codes", "keys", "labels")
+
+# seconds a staging directory (<hash>.tmp-<pid>) is left alone by the cache cleanup, another process may still be writing it;
+# older ones are leftovers of a process that died mid-write
+HOLDINGS_CACHE_STAGING_GRACE_SECONDS = 3600
+
+# identify the company behind a holding as a column of the weight matrix: LEI, then CUSIP, then normalized name
+def company_column_key(name, title, lei, cusip):
+    if lei:
+        return f"lei:{lei.upper()}"
+    if cusip:
+        return f"cusip:{cusip.upper()}"
+    return f"name:{matching_utils.normalize_company_name(name or title)}"
+
+# convert parsed holding tuples into the columnar layout of the holdings cache (company keys dictionary-encoded)
+# { column: array }
+def holding_columns(holdings):
+    codes = {}
+    labels = []
+    key_codes, pct_vals, val_usds = [], [], []
+
+    for name, title, lei, cusip, pct_val, val_usd in holdings:
+        key = company_column_key(name, title, lei, cusip)
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(labels)
+            labels.append(name or title or key)
+
+        key_codes.append(code)
+        pct_vals.append(np.nan if pct_val is None else pct_val)
+        val_usds.append(np.nan if val_usd is None else val_usd)
+
+    return {
+        "pct_val": np.array(pct_vals, dtype=np.float64),
+        "val_usd": np.array(val_usds, dtype=np.float64),
+        "key_codes": np.array(key_codes, dtype=np.int32),
+        "keys": np.array(list(codes), dtype=str),
+        "labels": np.array(labels, dtype=str),
+    }
+
+# write the columns of one filing's holdings to the cache (written aside, then renamed into place)
+def write_holdings_cache(content_hash, holdings, cache_dir=None):
+    cache_dir = cache_dir or HOLDINGS_CACHE_DIR
+    path = os.path.join(cache_dir, content_hash)
+    if os.path.isdir(path):
+        return
+
+    staging = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(staging, exist_ok=True)
+    for column, values in holding_columns(holdings).items():
+        np.save(os.path.join(staging, f"{column}.npy"), values)
+
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # another process cached the same filing first
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return
+
+# open one filing's cached columns memory-mapped (read only, shared between processes through the page cache)
+# None when the filing is not cached
+def load_holdings_cache(content_hash, cache_dir=None):
+    path = os.path.join(cache_dir or HOLDINGS_CACHE_DIR, content_hash)
+    if not os.path.isdir(path):
+        return None
+    return {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r") for column in HOLDINGS_CACHE_COLUMNS}
+
+# write the cache for every stored filing with parsed holdings that is not cached yet, and delete entries no fund references
+# (other processes' staging directories are kept until HOLDINGS_CACHE_STAGING_GRACE_SECONDS old)
+# run after refresh, returns the number of filings written
+def populate_holdings_cache(cache_dir=None, existing_connection=None):
+    cache_dir = cache_dir or HOLDINGS_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+
+    fund_hashes = db_utils.load_fund_content_hashes(None, existing_connection)
+    # share classes of the same filing are cached once
+    missing = {}
+    for fund, content_hash in fund_hashes.items():
+        if not os.path.isdir(os.path.join(cache_dir, content_hash)):
+            missing.setdefault(content_hash, fund)
+
+    written = 0
+    fund_holdings = db_utils.load_fund_holdings(list(missing.values()), existing_connection)
+    for content_hash, fund in missing.items():
+        if fund_holdings.get(fund):
+            write_holdings_cache(content_hash, fund_holdings[fund], cache_dir)
+            written += 1
+
+    referenced = set(fund_hashes.values())
+    for entry in os.listdir(cache_dir):
+        if entry in referenced:
+            continue
+        path = os.path.join(cache_dir, entry)
+        if ".tmp-" in entry:
+            try:
+                if time.time() - os.path.getmtime(path) < HOLDINGS_CACHE_STAGING_GRACE_SECONDS:
+                    continue
+            except OSError:
+                # renamed into place or removed by its writer meanwhile
+                continue
+        shutil.rmtree(path, ignore_errors=True)
+
+    print(f"Cached columnar holdings of {written} filing(s) in {cache_dir}")
+    return written
+
+# load the holdings of each fund, memory-mapped from the cache where its filing is cached and from the holdings table otherwise
+# { fund: columns or [ holding tuples ] or None } for funds in the database
+def load_fund_columns(funds, existing_connection=None):
+    fund_holdings = {}
+    if HOLDINGS_CACHE_DIR is not None:
+        for fund, content_hash in db_utils.load_fund_content_hashes(funds, existing_connection).items():
+            columns = load_holdings_cache(content_hash)
+            if columns is not None:
+                fund_holdings[fund] = columns
+
+    uncached = [fund for fund in funds if fund not in fund_holdings]
+    if uncached:
+        fund_holdings.update(db_utils.load_fund_holdings(uncached, existing_connection))
+
+    return fund_holdings
+
+# build the funds x companies weight matrix (pct_val of each company in each fund)
+# each fund's holdings may be holding tuples or cached columns, columns are mapped onto the shared company columns
+# through their (small) key dictionary, so the per-holding work stays vectorized
+# returns { fund: row }, [ company label per column ], matrix
+# pass a company_columns dict to have it filled with { company column key: column }
+def build_weight_matrix(fund_holdings, company_columns=None):
+    fund_rows = {fund: row for row, fund in enumerate(fund_holdings)}
+    if company_columns is None:
+        company_columns = {}
+    labels = []
+    rows, columns, weights = [], [], []
+
+    for fund, holdings in fund_holdings.items():
+        if not holdings:
+            continue
+        if not isinstance(holdings, dict):
+            holdings = holding_columns(holdings)
+
+        pct_val = np.asarray(holdings["pct_val"])
+        present = ~np.isnan(pct_val)
+        key_codes = np.asarray(holdings["key_codes"])[present]
+
+        # only companies with a weight in this fund get a column
+        dictionary_columns = np.zeros(len(holdings["keys"]), dtype=np.intp)
+        for code in np.unique(key_codes).tolist():
+            key = str(holdings["keys"][code])
+            column = company_columns.get(key)
+            if column is None:
+                column = company_columns[key] = len(labels)
+                labels.append(str(holdings["labels"][code]))
+            dictionary_columns[code] = column
+
+        rows.append(np.full(len(key_codes), fund_rows[fund], dtype=np.intp))
+        columns.append(dictionary_columns[key_codes])
+        weights.append(pct_val[present])
+
+    matrix = np.zeros((len(fund_rows), len(labels)))
+    if rows:
+        np.add.at(matrix, (np.concatenate(rows), np.concatenate(columns)), np.concatenate(weights))
+
+    return fund_rows, labels, matrix
+
+# fold the rows of held funds into the rows of the funds holding them, scaled by the position's pct_val (a percentage)
+# rows are expanded children first (finance_utils.look_through_order), so every row is final before a fund holding it reads it
+# position_columns { (fund, held fund): [ columns ] } are the holder's own columns for its position in the held fund,
+# zeroed once that position is replaced by the held fund's weights so the money is not counted twice
+# (a held fund without any known holdings keeps the position as it is)
+def look_through_weights(weights, fund_rows, order, links, position_columns=None):
+    for fund in order:
+        row = fund_rows.get(fund)
+        if row is None:
+            continue
+        for held_fund, pct_val in links[fund]:
+            held_row = fund_rows.get(held_fund)
+            if held_row is None or (position_columns is not None and not weights[held_row].any()):
+                continue
+            if position_columns is not None:
+                weights[row, position_columns.get((fund, held_fund), [])] = 0.0
+            weights[row] += pct_val / 100 * weights[held_row]
+    return weights
+
+# the weight matrix columns of each fund's positions in other funds (see db_utils.load_fund_link_positions)
+# { (fund, held fund): [ columns ] }
+def held_fund_columns(link_positions, company_columns):
+    columns = {}
+    for fund, held in link_positions.items():
+        for held_fund, holding, pct_val in held:
+            column = company_columns.get(company_column_key(*holding))
+            if column is not None:
+                columns.setdefault((fund, held_fund), []).append(column)
+    return columns
+
+# turn [ (user, fund, shares) ] positions into a users x funds share matrix lined up with the weight matrix rows
+def build_share_matrix(positions, user_ids, fund_rows):
+    user_rows = {user: row for row, user in enumerate(user_ids)}
+    shares = np.zeros((len(user_rows), len(fund_rows)))
+
+    for user, fund, amount in positions:
+        if fund in fund_rows:
+            shares[user_rows[user], fund_rows[fund]] += amount
+
+    return shares
+
+# pick the top_n largest non-zero exposures of one exposure vector, largest first, rounded to cents
+def top_exposures(exposure_vector, labels, top_n=None):
+    nonzero = np.flatnonzero(exposure_vector)
+    if top_n is not None and top_n < len(nonzero):
+        nonzero = nonzero[np.argpartition(-exposure_vector[nonzero], top_n - 1)[:top_n]]
+    ordered = nonzero[np.argsort(-exposure_vector[nonzero], kind="stable")]
+
+    return [(labels[column], round(float(exposure_vector[column]), 2)) for column in ordered]
+
+# compute the full exposure vector of every requested user (or every user when user_ids is None)
+# the weight matrix is built once and each block of users is one matrix-matrix product
+# { user: [ (company, amount), ... ] } ordered by amount
+@instrumentation_utils.span("calculate_all_exposures_many")
+def calculate_all_exposures_many(user_ids=None, top_n=None, existing_connection=None):
+    conn = db_utils.get_connection(existing_connection)
+
+    positions = db_utils.load_portfolios(user_ids, conn)
+    if user_ids is None:
+        user_ids = sorted({user for user, fund, amount in positions})
+
+    funds = sorted({fund for user, fund, amount in positions})
+    link_positions = db_utils.load_fund_link_positions(conn)
+    order, links = finance_utils.look_through_order(funds, db_utils.fund_links_from_positions(link_positions))
+    fund_holdings = load_fund_columns(order, conn)
+
+    # funds that are known but not parsed yet are fetched once, funds missing from the database carry no weight
+    for fund, holdings in fund_holdings.items():
+        if holdings is None:
+            fund_holdings[fund] = finance_utils.fetch_missing_holdings(fund, conn)
+
+    with instrumentation_utils.span("match"):
+        company_columns = {}
+        fund_rows, labels, weights = build_weight_matrix(fund_holdings, company_columns)
+        look_through_weights(weights, fund_rows, order, links, held_fund_columns(link_positions, company_columns))
+
+    with instrumentation_utils.span("aggregate"):
+        shares = build_share_matrix(positions, user_ids, fund_rows)
+
+        exposures = {}
+        for start in range(0, len(user_ids), USER_BLOCK_SIZE):
+            block = shares[start:start + USER_BLOCK_SIZE] @ weights
+            for offset, exposure_vector in enumerate(block):
+                exposures[user_ids[start + offset]] = top_exposures(exposure_vector, labels, top_n)
+
+    return exposures
+
+# compute everything a single user is exposed to as one matrix-vector product
+# [ (company, amount), ... ] ordered by amount
+def calculate_all_exposures(user_id, top_n=None, existing_connection=None):
+    return calculate_all_exposures_many([user_id], top_n, existing_connection)[user_id]
+
+# a user's exposure to each company in every report period of the filing history from start to end (YYYY-MM-DD, both optional)
+# the series is one pass over a companies x periods x funds weight array: each fund's weights carry forward from its latest filing
+# at or before a period (funds file on different months), held funds are looked through with today's fund-in-fund links,
+# and the current portfolio's shares are applied to every period in a single product
+# { company: [ (report_period, amount), ... ] } oldest first
+@instrumentation_utils.span("calculate_exposure_history")
+def calculate_exposure_history(user_id, companies, start=None, end=None, existing_connection=None):
+    conn = db_utils.get_connection(existing_connection)
+
+    portfolio = finance_utils.flatten_portfolio(db_utils.load_user_portfolio(user_id, conn))
+    order, links = finance_utils.look_through_order(list(portfolio), db_utils.load_fund_links(conn))
+
+    # periods before start are still read, they hold the weights carried into it
+    filings = db_utils.load_filing_periods(order, end, conn)
+    periods = sorted({report_period for fund, report_period in filings})
+    if not periods:
+        return {company: [] for company in companies}
+
+    for fund in sorted(set(portfolio) - {fund for fund, report_period in filings}):
+        print(f"No filing history for {fund}, it carries no weight in the series")
+
+    period_rows = {report_period: row for row, report_period in enumerate(periods)}
+    fund_columns = {fund: column for column, fund in enumerate(order)}
+
+    # row of each fund's latest filing at or before each period (-1 before its first filing)
+    filed = np.full((len(periods), len(order)), -1, dtype=np.intp)
+    for fund, report_period in filings:
+        filed[period_rows[report_period], fund_columns[fund]] = period_rows[report_period]
+    as_of = np.maximum.accumulate(filed, axis=0)
+
+    with instrumentation_utils.span("match"):
+        history = db_utils.lookup_exposure_history(companies, order, end, conn)
+        weights = np.zeros((len(companies), len(periods), len(order)))
+        for index, company in enumerate(companies):
+            for report_period, fund, pct_val in history[company]:
+                weights[index, period_rows[report_period], fund_columns[fund]] = pct_val
+
+    with instrumentation_utils.span("aggregate"):
+        reported = as_of >= 0
+        weights = np.where(reported, weights[:, np.maximum(as_of, 0), np.arange(len(order))], 0.0)
+        # funds as the leading axis, so look_through_weights folds whole companies x periods slices at once
+        look_through_weights(np.moveaxis(weights, 2, 0), fund_columns, order, links)
+        # a fund only looks through in periods it had filed by
+        weights *= reported
+        amounts = weights @ np.array([portfolio.get(fund, 0) for fund in order], dtype=np.float64)
+
+    shown = [row for row, report_period in enumerate(periods) if start is None or report_period >= start]
+    return {
+        company: [(periods[row], round(float(amounts[index, row]), 2)) for row in shown]
+        for index, company in enumerate(companies)
+    }
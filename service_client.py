@@ -0,0 +1,41 @@
+import json
+import socket
+
+# only the standard library is imported here, so a client call does not pay for requests, dotenv or opening the database
+
+# where the exposure service (python cli.py serve) listens, localhost only
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+
+# seconds a client waits for the service to connect and answer
+SERVICE_TIMEOUT_SECONDS = 60
+
+# raised by call() when the service answers with a JSON-RPC error
+class ServiceError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+# one JSON-RPC 2.0 call to the exposure service, messages are single lines of JSON
+# params is a list of positional arguments or a dict of keyword arguments
+# raises ConnectionRefusedError naming host:port when nothing listens there
+def call(method, params=None, host=SERVICE_HOST, port=SERVICE_PORT, timeout=SERVICE_TIMEOUT_SECONDS):
+    request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params if params is not None else []}
+
+    try:
+        connection = socket.create_connection((host, port), timeout=timeout)
+    except ConnectionRefusedError:
+        raise ConnectionRefusedError(f"No exposure service is listening on {host}:{port}") from None
+
+    with connection:
+        connection.sendall(json.dumps(request).encode() + b"\n")
+        with connection.makefile("rb") as stream:
+            line = stream.readline()
+
+    if not line:
+        raise ServiceError(-32000, "the exposure service closed the connection without answering")
+
+    response = json.loads(line)
+    if "error" in response:
+        raise ServiceError(response["error"]["code"], response["error"]["message"])
+    return response["result"]
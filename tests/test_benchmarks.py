@@ -0,0 +1,55 @@
+import json
+import pytest
+from unittest.mock import patch
+
+import benchmarks
+import data_scraping_utils
+
+
+# ─────────────────────────────────────────────
+# synthetic data
+# ─────────────────────────────────────────────
+
+def test_synthetic_filing_parses_back_into_its_holdings():
+    holdings = benchmarks.synthetic_holdings(50)
+    document = benchmarks.synthetic_nport_document(holdings)
+
+    assert data_scraping_utils.parse_nport_holdings(document) == holdings
+
+
+def test_synthetic_data_is_reproducible():
+    assert benchmarks.synthetic_holdings(50) == benchmarks.synthetic_holdings(50)
+    assert benchmarks.synthetic_portfolios(10) == benchmarks.synthetic_portfolios(10)
+    assert len(benchmarks.synthetic_portfolios(10)) == 10 * benchmarks.FUNDS_PER_USER
+
+
+# ─────────────────────────────────────────────
+# runner
+# ─────────────────────────────────────────────
+
+def test_run_benchmarks_reports_every_path(tmp_path):
+    with patch("benchmarks.BENCHMARK_COMPANIES", 10), patch("benchmarks.BENCHMARK_FUNDS", 4):
+        report = benchmarks.run_benchmarks(filing_sizes=(50,), user_counts=(1, 5), rounds=1)
+
+    assert {name.split("/")[0] for name in report["results"]} == {"parse", "match", "matrix", "db", "e2e"}
+    assert "e2e/calculate_all_exposures_many/5" in report["results"]
+    assert all(result["median"] >= 0 for result in report["results"].values())
+    json.dumps(report)
+
+
+def test_find_regressions_applies_threshold():
+    baseline = {"results": {"a": {"median": 1.0}, "b": {"median": 1.0}, "gone": {"median": 1.0}}}
+    report = {"results": {"a": {"median": 1.1}, "b": {"median": 1.5}, "new": {"median": 9.0}}}
+
+    assert benchmarks.find_regressions(report, baseline, threshold=0.2) == [("b", 1.0, 1.5, 1.5)]
+
+
+def test_main_fails_on_regression(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"results": {"parse/nport/500": {"median": 1e-9}}}))
+
+    with patch("benchmarks.run_benchmarks", return_value={"results": {"parse/nport/500": {"median": 1.0}}}):
+        with pytest.raises(SystemExit):
+            benchmarks.main(str(tmp_path / "out.json"), str(baseline))
+
+    assert json.loads((tmp_path / "out.json").read_text())["results"]["parse/nport/500"]["median"] == 1.0
@@ -0,0 +1,91 @@
+import threading
+import pytest
+
+import cache_utils
+
+
+# ─────────────────────────────────────────────
+# approximate_size()
+# ─────────────────────────────────────────────
+
+def test_approximate_size_counts_nested_values():
+    holding = ("Amazon.com Inc", "Amazon.com Inc", "", "", 2.5, None)
+
+    assert cache_utils.approximate_size([holding, holding]) > 2 * cache_utils.approximate_size(holding)
+
+
+# ─────────────────────────────────────────────
+# LRUCache
+# ─────────────────────────────────────────────
+
+def test_cache_counts_hits_and_misses():
+    cache = cache_utils.LRUCache(10_000)
+    cache.put("VFIAX", [1, 2, 3], "abc")
+
+    assert cache.get("VFIAX", "abc") == [1, 2, 3]
+    assert cache.get("FXAIX", "abc") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_cache_treats_other_version_as_miss_and_drops_entry():
+    cache = cache_utils.LRUCache(10_000)
+    cache.put("VFIAX", [1, 2, 3], "old")
+
+    assert cache.get("VFIAX", "new") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_cache_evicts_least_recently_used_entries_by_size():
+    value = list(range(10))
+    size = cache_utils.approximate_size(value)
+    cache = cache_utils.LRUCache(size * 2)
+
+    cache.put("A", value)
+    cache.put("B", value)
+    cache.get("A")
+    cache.put("C", value)
+
+    assert cache.get("B") is None
+    assert cache.get("A") == value and cache.get("C") == value
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_cache_skips_values_larger_than_budget():
+    cache = cache_utils.LRUCache(10)
+    cache.put("A", list(range(100)))
+
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_invalidate_and_clear():
+    cache = cache_utils.LRUCache(10_000)
+    cache.put("A", [1])
+    cache.put("B", [2])
+
+    cache.invalidate("A")
+    assert cache.get("A") is None
+    cache.clear()
+    assert cache.stats()["bytes"] == 0 and cache.get("B") is None
+
+
+def test_cache_stays_consistent_under_concurrent_use():
+    cache = cache_utils.LRUCache(cache_utils.approximate_size([0]) * 8)
+
+    def worker(offset):
+        for i in range(500):
+            cache.put(offset * 1000 + i % 20, [i])
+            cache.get(offset * 1000 + (i + 1) % 20)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.bytes == sum(size for version, value, size in cache.entries.values())
+    assert cache.bytes <= cache.max_bytes
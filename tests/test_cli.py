@@ -0,0 +1,130 @@
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import pytest
+from unittest.mock import patch
+
+import cli
+import db_utils
+
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cli.py")
+
+# seconds python cli.py portfolio may spend importing modules (the interpreter's own site start-up is not counted)
+PORTFOLIO_IMPORT_BUDGET_SECONDS = 0.1
+
+# modules portfolio must never pay for
+NETWORK_AND_NUMERIC_MODULES = ("requests", "dotenv", "numpy", "data_scraping_utils", "finance_utils", "matrix_utils")
+
+
+# ─────────────────────────────────────────────
+# command registry
+# ─────────────────────────────────────────────
+
+def test_every_command_in_usage_has_a_handler():
+    usage_commands = {line.split()[0] for line in cli.USAGE.splitlines()[3:] if line.startswith("  ") and not line.strip().startswith("--")}
+
+    assert usage_commands <= set(cli.COMMANDS)
+
+
+def test_unknown_command_exits():
+    with pytest.raises(SystemExit):
+        cli.run_command("no-such-command", [])
+
+
+def test_remote_is_refused_for_local_only_commands():
+    with pytest.raises(ValueError):
+        cli.run_command("get-url", ["VFIAX"], remote=("127.0.0.1", 8765))
+
+
+def test_remote_portfolio_asks_the_service_without_the_database(capsys):
+    with patch("cli.service_client.call", return_value=[["VFIAX", 100]]) as mock_call, \
+         patch("db_utils.load_user_portfolio") as mock_load:
+        cli.run_command("portfolio", ["1"], remote=("127.0.0.1", 8765))
+
+    mock_call.assert_called_once_with("portfolio", [1], "127.0.0.1", 8765)
+    mock_load.assert_not_called()
+    assert "VFIAX" in capsys.readouterr().out
+
+
+def test_remote_commands_ask_the_service_on_the_given_host_and_port(capsys):
+    with patch("sys.argv", ["cli.py", "exposures-all", "1", "--remote", "--port", "8799", "--host", "localhost"]), \
+         patch("cli.service_client.call", return_value=[["Amazon.com Inc", 250.0]]) as mock_call:
+        cli.main()
+
+    mock_call.assert_called_once_with("exposures_all", [1, None], "localhost", 8799)
+    assert "Amazon.com Inc" in capsys.readouterr().out
+
+
+def test_refused_remote_call_names_the_address_it_tried(capsys):
+    with patch("sys.argv", ["cli.py", "portfolio", "1", "--remote", "--port", "1"]), pytest.raises(SystemExit):
+        cli.main()
+
+    assert "No exposure service is listening on 127.0.0.1:1" in capsys.readouterr().out
+
+
+
+def test_exposure_history_shows_every_company_with_a_series(capsys):
+    history = {"Amazon.com Inc": [], "Apple Inc": [["2025-03-31", 700.0]]}
+    with patch("cli.service_client.call", return_value=history):
+        cli.run_command("exposure-history", ["1", "Amazon.com Inc", "Apple Inc"], remote=("127.0.0.1", 8765))
+
+    out = capsys.readouterr().out
+    assert "No exposure history found for Amazon.com Inc." in out
+    assert "$700.00" in out
+
+
+def test_exposure_history_without_any_filing_history_says_so_once(capsys):
+    with patch("cli.service_client.call", return_value={"Amazon.com Inc": [], "Apple Inc": []}):
+        cli.run_command("exposure-history", ["1", "Amazon.com Inc", "Apple Inc"], remote=("127.0.0.1", 8765))
+
+    assert capsys.readouterr().out.count("No filing history found for user 1's funds.") == 1
+
+
+@pytest.mark.parametrize("metrics, reports", [([], 1), (["--metrics", "prometheus"], 1), (["--metrics", "json"], 1)])
+def test_profile_prints_its_report_once_with_or_without_metrics(capsys, metrics, reports):
+    with patch("sys.argv", ["cli.py", "portfolio", "1", "--remote", "--profile"] + metrics), \
+         patch("cli.service_client.call", return_value=[["VFIAX", 100]]), \
+         patch("cli.instrumentation_utils.PROFILED_SPANS", set()):
+        cli.main()
+    cli.instrumentation_utils.reset()
+
+    assert capsys.readouterr().out.count("function calls") == reports
+
+# ─────────────────────────────────────────────
+# start-up imports
+# ─────────────────────────────────────────────
+
+# { module: cumulative microseconds } of the top-level imports made by the script itself (after site has finished)
+def script_imports(importtime_output):
+    imports, after_site = {}, False
+    for line in importtime_output.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match is None:
+            continue
+        cumulative, indent, module = int(match.group(1)), match.group(2), match.group(3)
+        if indent:
+            continue
+        if module == "site":
+            after_site = True
+        elif after_site:
+            imports[module] = cumulative
+    return imports
+
+
+def test_portfolio_startup_stays_within_import_budget(tmp_path):
+    conn = sqlite3.connect(tmp_path / "finance_data.db")
+    db_utils.migrate_schema(conn)
+    conn.close()
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", CLI_PATH, "portfolio", "1"], cwd=tmp_path, capture_output=True, text=True, check=True
+    )
+
+    imports = script_imports(result.stderr)
+    nested = {line.split("|")[2].strip() for line in result.stderr.splitlines() if line.startswith("import time:") and "|" in line}
+    assert "No holdings found for user 1." in result.stdout
+    assert not nested & set(NETWORK_AND_NUMERIC_MODULES)
+    assert sum(imports.values()) / 1e6 < PORTFOLIO_IMPORT_BUDGET_SECONDS
@@ -1,9 +1,17 @@
 
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 from unittest.mock import patch, MagicMock
 
 import db_utils
 import data_scraping_utils
+import finance_utils
 
 
 # ─────────────────────────────────────────────
@@ -30,6 +38,100 @@ def test_connect_uses_correct_filename():
         mock_sqlite.assert_called_once_with("finance_data.db")
         assert result is mock_sqlite.return_value
 
+
+# ─────────────────────────────────────────────
+# get_connection()
+# ─────────────────────────────────────────────
+
+@pytest.fixture
+def thread_db(tmp_path):
+    with patch("db_utils.DB_FILE", str(tmp_path / "finance_data.db")):
+        db_utils.close_connection()
+        yield
+        db_utils.close_connection()
+
+
+def test_get_connection_returns_given_connection(mock_conn):
+    assert db_utils.get_connection(mock_conn) is mock_conn
+
+
+def test_get_connection_reuses_one_connection_per_thread(thread_db):
+    conn = db_utils.get_connection()
+    assert db_utils.get_connection() is conn
+
+    other = []
+    worker = threading.Thread(target=lambda: other.append(db_utils.get_connection()))
+    worker.start()
+    worker.join()
+    assert other[0] is not conn
+
+
+def test_get_connection_applies_pragmas(thread_db):
+    cursor = db_utils.get_connection().cursor()
+    assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 1 # NORMAL
+    assert cursor.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+
+def test_close_connection_opens_fresh_connection_next_time(thread_db):
+    conn = db_utils.get_connection()
+    db_utils.close_connection()
+    assert db_utils.get_connection() is not conn
+
+# ─────────────────────────────────────────────
+# migrate_schema()
+# ─────────────────────────────────────────────
+
+def test_migrate_schema_creates_current_schema():
+    conn = sqlite3.connect(":memory:")
+
+    assert db_utils.migrate_schema(conn) == len(db_utils.SCHEMA_MIGRATIONS)
+
+    fund_columns = [row[1] for row in conn.execute("PRAGMA table_info(funds)")]
+    assert "nport_document" not in fund_columns
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT fund, amount FROM portfolios WHERE user = ?", (1,)).fetchall()
+    assert "COVERING INDEX idx_portfolios_user_fund_amount" in plan[0][3]
+
+
+def test_migrate_schema_upgrades_unversioned_database_without_losing_data():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE funds (ticker TEXT PRIMARY KEY, sec_url TEXT, nport_document TEXT, last_updated TEXT)")
+    conn.execute("INSERT INTO funds (ticker, sec_url, nport_document) VALUES ('VFIAX', 'http://x.com/0000036405-25-000125.txt', ?)", (SAMPLE_NPORT,))
+    conn.execute("CREATE TABLE portfolios (id INTEGER PRIMARY KEY AUTOINCREMENT, fund TEXT NOT NULL, amount INTEGER NOT NULL, user INTEGER NOT NULL)")
+    conn.execute("INSERT INTO portfolios (fund, amount, user) VALUES ('VFIAX', 10, 7)")
+    conn.commit()
+
+    db_utils.migrate_schema(conn)
+
+    assert db_utils.load_user_portfolio(7, conn) == [("VFIAX", 10)]
+    assert db_utils.load_funds_from_cache(["VFIAX"], conn) == {"VFIAX": SAMPLE_NPORT}
+    assert conn.execute("SELECT accession FROM filings").fetchone() == ("0000036405-25-000125",)
+
+
+def test_migrate_schema_skips_applied_migrations():
+    conn = sqlite3.connect(":memory:")
+    db_utils.migrate_schema(conn)
+
+    with patch("db_utils.SCHEMA_MIGRATIONS", db_utils.SCHEMA_MIGRATIONS + [MagicMock()]) as migrations:
+        assert db_utils.migrate_schema(conn) == len(migrations)
+        assert db_utils.migrate_schema(conn) == len(migrations)
+
+    migrations[-1].assert_called_once_with(conn)
+
+
+def test_migrate_schema_rolls_back_failed_migration():
+    conn = sqlite3.connect(":memory:")
+    db_utils.migrate_schema(conn)
+    failing = MagicMock(side_effect=lambda c: (c.execute("CREATE TABLE half_done (x)"), 1 / 0))
+
+    with patch("db_utils.SCHEMA_MIGRATIONS", db_utils.SCHEMA_MIGRATIONS + [failing]):
+        with pytest.raises(ZeroDivisionError):
+            db_utils.migrate_schema(conn)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db_utils.SCHEMA_MIGRATIONS)
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+
 # ─────────────────────────────────────────────
 # fetch_nport_from_sec_url()
 # ─────────────────────────────────────────────
@@ -42,27 +144,47 @@ def test_fetch_nport_returns_none_when_no_url_in_db():
 
 def test_fetch_nport_fetches_and_returns_text():
     mock_response = MagicMock()
+    mock_response.ok = True
+    mock_response.status_code = 200
     mock_response.text = "<nport>data</nport>"
+    mock_session = MagicMock()
+    mock_session.get.return_value = mock_response
 
     with patch("finance_utils.db_utils.get_sec_url", return_value="http://sec.gov/test"), \
-         patch("finance_utils.data_scraping_utils.os.getenv", return_value="test@example.com"), \
-         patch("finance_utils.data_scraping_utils.requests.get", return_value=mock_response) as mock_get:
+         patch("data_scraping_utils.get_sec_session", return_value=mock_session), \
+         patch("data_scraping_utils.SEC_RATE_LIMITER") as mock_limiter:
         result = data_scraping_utils.fetch_nport_from_sec_url("VFIAX")
 
     assert result == "<nport>data</nport>"
-    mock_get.assert_called_once()
+    mock_session.get.assert_called_once_with("http://sec.gov/test", timeout=data_scraping_utils.REQUEST_TIMEOUT_SECONDS)
+    mock_limiter.acquire.assert_called_once()
+
+
+def test_fetch_nport_returns_none_when_the_sec_refuses(stub_sec_server):
+    stub_sec_server.failures["/vfiax.txt"] = data_scraping_utils.MAX_RETRIES + 1
+
+    with patch("finance_utils.db_utils.get_sec_url", return_value=stub_sec_server.url("/vfiax.txt")):
+        assert data_scraping_utils.fetch_nport_from_sec_url("VFIAX") is None
 
 # ─────────────────────────────────────────────
 # load_funds_from_cache()
 # ─────────────────────────────────────────────
 
 def test_load_funds_returns_dict(mock_conn):
-    rows = [("VFIAX", "<nport/>"), ("FXAIX", "<nport/>")]
+    rows = [("VFIAX", "abc", zlib.compress(b"<nport/>")), ("FXAIX", "abc", zlib.compress(b"<nport/>"))]
     mock_conn.cursor().fetchall.return_value = rows
 
     result = db_utils.load_funds_from_cache(["VFIAX", "FXAIX"], existing_connection=mock_conn)
 
-    assert result == dict(rows)
+    assert result == {"VFIAX": "<nport/>", "FXAIX": "<nport/>"}
+
+
+def test_load_funds_marks_funds_without_a_stored_filing_as_none(mock_conn):
+    mock_conn.cursor().fetchall.return_value = [("VFIAX", None, None)]
+
+    result = db_utils.load_funds_from_cache(["VFIAX"], existing_connection=mock_conn)
+
+    assert result == {"VFIAX": None}
 
 
 def test_load_funds_returns_empty_dict_for_unknown_tickers(mock_conn):
@@ -77,9 +199,670 @@ def test_load_funds_creates_connection_when_none_given():
     mock_conn = MagicMock()
     mock_conn.cursor().fetchall.return_value = []
 
-    with patch("db_utils.connect", return_value=mock_conn) as mock_connect:
+    with patch("db_utils.get_connection", return_value=mock_conn) as mock_get_connection:
         db_utils.load_funds_from_cache(["VFIAX"])
-        mock_connect.assert_called_once()
+        mock_get_connection.assert_called_once_with(None)
+
+
+# ─────────────────────────────────────────────
+# parse_nport_holdings()
+# ─────────────────────────────────────────────
+
+SAMPLE_NPORT = """<SEC-DOCUMENT>0000036405-25-000125.txt
+<TYPE>NPORT-P
+<TEXT>
+<XML>
+<?xml version="1.0" encoding="UTF-8"?>
+<edgarSubmission xmlns="http://www.sec.gov/edgar/nport">
+  <formData>
+    <invstOrSecs>
+      <invstOrSec>
+        <name>Amazon.com Inc</name>
+        <lei>ZXTILKJKG63JELOEG630</lei>
+        <title>Amazon.com Inc</title>
+        <cusip>023135106</cusip>
+        <valUSD>1500.25</valUSD>
+        <pctVal>2.5</pctVal>
+      </invstOrSec>
+      <invstOrSec>
+        <name>Cash Sleeve</name>
+        <lei>N/A</lei>
+        <title>Cash Sleeve</title>
+        <cusip>N/A</cusip>
+      </invstOrSec>
+    </invstOrSecs>
+  </formData>
+</edgarSubmission>
+</XML>
+</TEXT>
+</SEC-DOCUMENT>
+"""
+
+SAMPLE_HOLDINGS = [
+    ("Amazon.com Inc", "Amazon.com Inc", "ZXTILKJKG63JELOEG630", "023135106", 2.5, 1500.25),
+    ("Cash Sleeve", "Cash Sleeve", "", "", None, None),
+]
+
+# SAMPLE_NPORT with the report period (repPdDate) and fiscal year end (repPdEnd) of its <genInfo>
+DATED_NPORT = SAMPLE_NPORT.replace("<formData>", """<formData>
+    <genInfo>
+      <repPdEnd>2025-12-31</repPdEnd>
+      <repPdDate>2025-03-31</repPdDate>
+      <seriesLei>549300VFIAXSERIESLEI</seriesLei>
+    </genInfo>""")
+
+
+def test_parse_nport_holdings_extracts_compact_rows():
+    result = data_scraping_utils.parse_nport_holdings(SAMPLE_NPORT)
+
+    assert result == SAMPLE_HOLDINGS
+
+
+def test_parse_nport_holdings_records_the_report_period():
+    filing_info = {}
+
+    result = data_scraping_utils.parse_nport_holdings(DATED_NPORT, filing_info)
+
+    assert result == SAMPLE_HOLDINGS
+    assert filing_info == {"report_period": "2025-03-31", "series_lei": "549300VFIAXSERIESLEI"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_iter_nport_holdings_handles_markers_split_across_chunks(chunk_size):
+    raw = SAMPLE_NPORT.encode()
+    chunks = (raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size))
+
+    assert list(data_scraping_utils.iter_nport_holdings(chunks)) == SAMPLE_HOLDINGS
+
+
+def test_iter_nport_holdings_yields_nothing_without_xml():
+    assert list(data_scraping_utils.iter_nport_holdings([b'{"0": {"ticker": "AMZN"}}'])) == []
+
+
+def test_fetch_fund_filing_returns_none_when_no_url_in_db():
+    with patch("finance_utils.db_utils.get_sec_url", return_value=None):
+        result = data_scraping_utils.fetch_fund_filing("UNKNOWN")
+    assert result is None
+
+
+def test_fetch_fund_filing_streams_the_filing_over_the_sec_session():
+    mock_response = MagicMock()
+    mock_response.ok = True
+    mock_response.iter_content.return_value = iter([DATED_NPORT[:100].encode(), DATED_NPORT[100:].encode()])
+    mock_response.__enter__.return_value = mock_response
+
+    mock_session = MagicMock()
+    mock_session.get.return_value = mock_response
+    mock_response.status_code = 200
+
+    with patch("finance_utils.db_utils.get_sec_url", return_value="http://sec.gov/test"), \
+         patch("data_scraping_utils.get_sec_session", return_value=mock_session):
+        result = data_scraping_utils.fetch_fund_filing("VFIAX")
+
+    assert result["holdings"] == SAMPLE_HOLDINGS
+    assert (result["url"], result["report_period"], result["content_hash"]) == ("http://sec.gov/test", "2025-03-31", hashlib.sha256(DATED_NPORT.encode()).hexdigest())
+    assert mock_session.get.call_args.kwargs["stream"] is True
+
+
+# ─────────────────────────────────────────────
+# fetch_holdings_concurrently() against a local stub SEC server
+# ─────────────────────────────────────────────
+
+class StubSECHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            failures = server.failures.get(self.path, 0)
+            server.failures[self.path] = max(failures - 1, 0)
+
+        if failures:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if server.etag and self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = SAMPLE_NPORT.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if server.etag:
+            self.send_header("ETag", server.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_sec_server():
+    """A local HTTP server serving SAMPLE_NPORT, recording every path requested."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSECHandler)
+    server.requests, server.failures, server.lock, server.etag = [], {}, threading.Lock(), None
+    server.url = lambda path: f"http://127.0.0.1:{server.server_port}{path}"
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+
+    with patch("data_scraping_utils.RETRY_BACKOFF_SECONDS", 0), \
+         patch("data_scraping_utils.SEC_RATE_LIMITER", data_scraping_utils.RateLimiter(1000)), \
+         patch("data_scraping_utils.SEC_SESSION", None), \
+         patch("data_scraping_utils.load_dotenv"):
+        yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_fetch_dedupes_shared_urls(stub_sec_server):
+    urls = [stub_sec_server.url("/a.txt"), stub_sec_server.url("/b.txt"), stub_sec_server.url("/a.txt")]
+
+    result = data_scraping_utils.fetch_holdings_concurrently(urls)
+
+    assert [result[url]["holdings"] for url in urls] == [SAMPLE_HOLDINGS] * 3
+    assert result[urls[0]]["content_hash"] == hashlib.sha256(SAMPLE_NPORT.encode()).hexdigest()
+    assert sorted(stub_sec_server.requests) == ["/a.txt", "/b.txt"]
+
+
+def test_concurrent_fetch_retries_unavailable_responses(stub_sec_server):
+    stub_sec_server.failures["/busy.txt"] = 2
+    url = stub_sec_server.url("/busy.txt")
+
+    result = data_scraping_utils.fetch_holdings_concurrently([url])
+
+    assert result[url]["holdings"] == SAMPLE_HOLDINGS
+    assert stub_sec_server.requests == ["/busy.txt"] * 3
+
+
+def test_concurrent_fetch_gives_up_after_max_retries(stub_sec_server):
+    stub_sec_server.failures["/down.txt"] = 100
+    url = stub_sec_server.url("/down.txt")
+
+    result = data_scraping_utils.fetch_holdings_concurrently([url])
+
+    assert result == {url: None}
+    assert len(stub_sec_server.requests) == data_scraping_utils.MAX_RETRIES + 1
+
+
+def test_concurrent_fetch_sends_conditional_requests(stub_sec_server):
+    stub_sec_server.etag = '"v1"'
+    url = stub_sec_server.url("/a.txt")
+
+    first = data_scraping_utils.fetch_holdings_concurrently([url])
+    second = data_scraping_utils.fetch_holdings_concurrently([url], validators={url: (first[url]["etag"], None)})
+
+    assert first[url]["etag"] == '"v1"'
+    assert second == {url: data_scraping_utils.NOT_MODIFIED}
+
+
+def test_rate_limiter_spaces_requests_at_the_configured_rate():
+    limiter = data_scraping_utils.RateLimiter(50)
+
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+
+    # first token is immediate, the next five wait 1/50s each
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+
+
+# ─────────────────────────────────────────────
+# resolve_companies() / link_company_tickers()
+# ─────────────────────────────────────────────
+
+def test_resolve_companies_merges_by_identifier_and_normalized_name():
+    fidelity = [
+        ["Amazon.com Inc", "Amazon.com Inc", "ZXTILKJKG63JELOEG630", ""],
+        ["Apple Inc", "Apple Inc", "", "037833100"],
+    ]
+    vanguard = [
+        ["AMAZON.COM INC", "AMAZON.COM INC", "ZXTILKJKG63JELOEG630", "023135106"],
+        ["Apple Inc.", "APPLE INC", "", ""],
+        ["Netflix Inc", "Netflix Inc", "", "64110L106"],
+    ]
+    index_fund = [["Netflix", "Netflix", "", "64110L106"]]
+
+    result = data_scraping_utils.resolve_companies([fidelity, vanguard, index_fund])
+
+    assert result == [
+        ["Amazon.com Inc", "Amazon.com Inc", "ZXTILKJKG63JELOEG630", "023135106"],
+        ["Apple Inc", "Apple Inc", "", "037833100"],
+        ["Netflix Inc", "Netflix Inc", "", "64110L106"],
+    ]
+
+
+def test_resolve_companies_keeps_companies_with_different_identifiers_apart():
+    result = data_scraping_utils.resolve_companies([
+        [["Alphabet Inc", "Alphabet Inc Class A", "5493006MHB84DD0ZWV18", "02079K305"]],
+        [["Berkshire Hathaway Inc", "Berkshire Hathaway Inc", "5493000C01ZX7D35SD85", "084670702"]],
+    ])
+
+    assert [company[0] for company in result] == ["Alphabet Inc", "Berkshire Hathaway Inc"]
+
+
+def test_link_company_tickers_matches_normalized_sec_titles():
+    companies = [["Amazon.com Inc", "Amazon.com Inc", "", ""], ["Unlisted Co", "Unlisted Co", "", ""]]
+    company_tickers = {
+        "0": {"cik_str": 1018724, "ticker": "AMZN", "title": "AMAZON COM INC"},
+        "1": {"cik_str": 1, "ticker": "DUP", "title": "Amazon.com, Inc. /NEW/"},
+    }
+
+    match_count = data_scraping_utils.link_company_tickers(companies, company_tickers)
+
+    assert match_count == 1
+    assert companies[0][4:] == ["AMZN", "0001018724"]
+    assert len(companies[1]) == 4
+
+
+# ─────────────────────────────────────────────
+# load_fund_holdings() / store_fund_holdings()
+# ─────────────────────────────────────────────
+
+@pytest.fixture(autouse=True)
+def empty_holdings_cache():
+    db_utils.HOLDINGS_CACHE.clear()
+    yield
+    db_utils.HOLDINGS_CACHE.clear()
+
+
+@pytest.fixture
+def holdings_conn():
+    """A real in-memory DB with the current schema."""
+    conn = sqlite3.connect(":memory:")
+    db_utils.migrate_schema(conn)
+    conn.executemany("INSERT INTO funds (ticker) VALUES (?)", [("VFIAX",), ("FXAIX",)])
+    yield conn
+    conn.close()
+
+
+def test_load_fund_holdings_serves_repeat_reads_from_cache(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+
+    first = db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+    hits = db_utils.HOLDINGS_CACHE.stats()["hits"]
+    holdings_conn.execute("DELETE FROM holdings") # a cache hit never reaches the table
+    second = db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+
+    assert second == first
+    assert db_utils.HOLDINGS_CACHE.stats()["hits"] == hits + 1
+
+
+def test_new_document_invalidates_cached_holdings(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", [("Old Co", "Old Co", "", "", 1.0, 10.0)], holdings_conn)
+    db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+
+    db_utils.update_existing_fund("VFIAX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+    result = db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+
+    assert [holding[0] for holding in result["VFIAX"]] == ["Amazon.com Inc", "Cash Sleeve"]
+
+
+def test_exposure_results_are_invalidated_when_a_fund_is_reindexed(holdings_conn):
+    db_utils.store_exposure_result("vfiax-key", ["VFIAX"], {"Amazon.com Inc": 250.0}, holdings_conn)
+    db_utils.store_exposure_result("fxaix-key", ["FXAIX"], {"Amazon.com Inc": 20.0}, holdings_conn)
+    versions = db_utils.load_holdings_versions(["VFIAX", "FXAIX"], holdings_conn)
+
+    assert db_utils.load_exposure_result("vfiax-key", holdings_conn) == {"Amazon.com Inc": 250.0}
+
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+
+    assert db_utils.load_exposure_result("vfiax-key", holdings_conn) is None
+    assert db_utils.load_exposure_result("fxaix-key", holdings_conn) == {"Amazon.com Inc": 20.0}
+    assert db_utils.load_holdings_versions(["VFIAX", "FXAIX"], holdings_conn) == {"VFIAX": versions["VFIAX"] + 1, "FXAIX": versions["FXAIX"]}
+
+
+def test_prune_exposure_results_bounds_age_and_size(holdings_conn):
+    for key in ("a", "b", "c"):
+        db_utils.store_exposure_result(key, ["VFIAX"], {"Amazon.com Inc": 1.0}, holdings_conn)
+    holdings_conn.execute("UPDATE exposure_results SET created = '2000-01-01T00:00:00' WHERE cache_key = 'a'")
+    holdings_conn.execute("UPDATE exposure_results SET created = '2999-01-01T00:00:00' WHERE cache_key = 'c'")
+
+    with patch("db_utils.EXPOSURE_RESULTS_MAX_ROWS", 1):
+        assert db_utils.prune_exposure_results(holdings_conn) == 2
+
+    assert holdings_conn.execute("SELECT cache_key FROM exposure_results").fetchall() == [("c",)]
+
+
+def test_store_fund_holdings_replaces_previous_rows(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", [("Old Co", "Old Co", "", "", 1.0, 10.0)], holdings_conn)
+    db_utils.store_fund_holdings("VFIAX", [("New Co", "New Co", "", "", 2.0, 20.0)], holdings_conn)
+
+    result = db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+
+    assert result == {"VFIAX": [("New Co", "New Co", "", "", 2.0, 20.0)]}
+
+
+def test_storing_the_same_holdings_again_changes_nothing(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+    db_utils.store_exposure_result("vfiax-key", ["VFIAX"], {"Amazon.com Inc": 250.0}, holdings_conn)
+    versions = db_utils.load_holdings_versions(["VFIAX"], holdings_conn)
+
+    changes = db_utils.store_fund_holdings("VFIAX", list(SAMPLE_HOLDINGS), holdings_conn)
+
+    assert changes == {"added": [], "removed": [], "changed": []}
+    assert db_utils.load_holdings_versions(["VFIAX"], holdings_conn) == versions
+    assert db_utils.load_exposure_result("vfiax-key", holdings_conn) == {"Amazon.com Inc": 250.0}
+
+
+def test_reweighted_position_is_updated_in_place(holdings_conn):
+    holdings = [("Amazon.com Inc", "Amazon.com Inc", "LEI-AMZN", "023135106", 2.5, 100.0), ("Cash Sleeve", "Cash Sleeve", "", "", 1.0, 5.0)]
+    db_utils.store_fund_holdings("VFIAX", holdings, holdings_conn)
+    rowids = holdings_conn.execute("SELECT rowid FROM holdings WHERE fund = 'VFIAX' ORDER BY rowid").fetchall()
+
+    changes = db_utils.store_fund_holdings("VFIAX", [holdings[0][:4] + (3.0, 120.0), holdings[1]], holdings_conn)
+
+    assert changes["changed"] == [("lei:LEI-AMZN", rowids[0][0], holdings[0], holdings[0][:4] + (3.0, 120.0))]
+    assert changes["added"] == [] and changes["removed"] == []
+    assert holdings_conn.execute("SELECT rowid FROM holdings WHERE fund = 'VFIAX' ORDER BY rowid").fetchall() == rowids
+    assert set(holdings_conn.execute("SELECT pct_val FROM exposure_index WHERE holding_id = ?", rowids[0]).fetchall()) == {(3.0,)}
+
+
+def test_holdings_changes_history_records_each_filing(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", [("Old Co", "Old Co", "", "", 1.0, 10.0)], holdings_conn, "hash-1")
+    db_utils.store_fund_holdings("VFIAX", [("New Co", "New Co", "", "", 2.0, 20.0)], holdings_conn, "hash-2")
+
+    history = db_utils.load_holdings_changes("VFIAX", existing_connection=holdings_conn)
+
+    assert [(content_hash, change, name) for recorded, content_hash, change, key, name, *values in history] == [
+        ("hash-1", "added", "Old Co"), ("hash-2", "added", "New Co"), ("hash-2", "removed", "Old Co")
+    ]
+    assert history[2][5:] == (1.0, None, 10.0, None)
+
+
+def test_load_fund_holdings_marks_unparsed_funds_as_none(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", [("Amazon.com Inc", "Amazon.com Inc", "", "", 2.5, None)], holdings_conn)
+
+    result = db_utils.load_fund_holdings(["VFIAX", "FXAIX", "UNKNOWN"], existing_connection=holdings_conn)
+
+    assert result == {"VFIAX": [("Amazon.com Inc", "Amazon.com Inc", "", "", 2.5, None)], "FXAIX": None}
+
+
+def test_update_fund_stores_document_once_in_filing_store(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+    db_utils.update_existing_fund("FXAIX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+
+    assert holdings_conn.execute("SELECT COUNT(*) FROM filings").fetchone() == (1,)
+    assert len(set(holdings_conn.execute("SELECT content_hash FROM funds").fetchall())) == 1
+    assert db_utils.load_funds_from_cache(["VFIAX", "FXAIX"], holdings_conn) == {"VFIAX": SAMPLE_NPORT, "FXAIX": SAMPLE_NPORT}
+
+
+def test_update_fund_parses_new_document_into_holdings(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+
+    result = db_utils.load_fund_holdings(["VFIAX"], existing_connection=holdings_conn)
+
+    assert [holding[0] for holding in result["VFIAX"]] == ["Amazon.com Inc", "Cash Sleeve"]
+
+
+# ─────────────────────────────────────────────
+# rebuild_exposure_index() / lookup_company_exposures()
+# ─────────────────────────────────────────────
+
+def test_lookup_finds_holding_by_name_lei_cusip_and_cik(holdings_conn):
+    holdings_conn.execute("INSERT INTO companies VALUES ('Amazon.com Inc', 'Amazon.com Inc', 'ZXTILKJKG63JELOEG630', '023135106', 'AMZN', '0001018724')")
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+
+    for query in ["AMAZON.COM, INC.", "ZXTILKJKG63JELOEG630", "023135106", "1018724"]:
+        result = db_utils.lookup_company_exposures([query], ["VFIAX"], holdings_conn)
+        assert result == {query: {"VFIAX": 2.5}}
+
+
+def test_lookup_resolves_tickers_through_companies_table(holdings_conn):
+    holdings_conn.execute("INSERT INTO companies VALUES ('Amazon.com Inc', 'Amazon.com Inc', 'ZXTILKJKG63JELOEG630', '023135106', 'AMZN', '0001018724')")
+    db_utils.store_fund_holdings("VFIAX", [("Amazon Holdco Sub", "Amazon Holdco Sub", "ZXTILKJKG63JELOEG630", "", 1.5, None)], holdings_conn)
+
+    assert db_utils.lookup_company_exposures(["amzn"], ["VFIAX"], holdings_conn) == {"amzn": {"VFIAX": 1.5}}
+
+
+def test_resolve_company_keys_uses_identifier_indexes(holdings_conn):
+    plan = holdings_conn.execute(
+        "EXPLAIN QUERY PLAN SELECT name FROM companies WHERE ticker = ? OR lei = ? OR cusip = ? OR cik = ?", ("A", "A", "A", None)
+    ).fetchall()
+
+    assert all("SCAN" not in row[3] for row in plan)
+    assert db_utils.resolve_company_keys(["Meta"], holdings_conn) == {"Meta": ["name:meta", "lei:META", "cusip:META"]}
+
+
+def test_resolve_company_keys_from_loaded_identifiers_matches_the_table(holdings_conn):
+    holdings_conn.execute("INSERT INTO companies VALUES ('Amazon.com Inc', 'Amazon.com Inc', 'ZXTILKJKG63JELOEG630', '023135106', 'AMZN', '0001018724')")
+    queries = ["amzn", "1018724", "023135106", "Netflix"]
+    from_table = db_utils.resolve_company_keys(queries, holdings_conn)
+
+    db_utils.hold_company_identifiers(holdings_conn)
+    try:
+        with patch("db_utils.load_company_identifiers") as mock_load:
+            assert db_utils.resolve_company_keys(queries, holdings_conn) == from_table
+        mock_load.assert_not_called()
+    finally:
+        db_utils.invalidate_company_identifiers()
+
+
+def test_held_identifiers_are_read_again_once_another_process_changes_the_companies_table(holdings_conn):
+    db_utils.hold_company_identifiers(holdings_conn)
+    try:
+        assert "cik:0001018724" not in db_utils.resolve_company_keys(["AMZN"], holdings_conn)["AMZN"]
+
+        holdings_conn.execute("INSERT INTO companies VALUES ('Amazon.com Inc', 'Amazon.com Inc', '', '', 'AMZN', '0001018724')")
+
+        assert "cik:0001018724" in db_utils.resolve_company_keys(["AMZN"], holdings_conn)["AMZN"]
+        assert "AMZN" in db_utils.COMPANY_IDENTIFIERS
+    finally:
+        db_utils.invalidate_company_identifiers()
+
+
+def test_lookup_counts_a_holding_once_across_matching_keys(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+
+    result = db_utils.lookup_company_exposures(["Amazon.com Inc", "Netflix"], ["VFIAX", "FXAIX"], holdings_conn)
+
+    assert result == {"Amazon.com Inc": {"VFIAX": 2.5}, "Netflix": {}}
+
+
+def test_load_fund_links_matches_held_funds_by_cusip(holdings_conn):
+    db_utils.update_existing_fund("FXAIX", cusip="315911750", existing_connection=holdings_conn)
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS + [("Fidelity 500 Index Fund", "Fidelity 500 Index Fund", "", "315911750", 3.0, None)], holdings_conn)
+    db_utils.store_fund_holdings("FXAIX", [("Fidelity 500 Index Fund", "Fidelity 500 Index Fund", "", "315911750", 1.0, None)], holdings_conn)
+
+    assert db_utils.load_fund_links(holdings_conn) == {"VFIAX": [("FXAIX", 3.0)]}
+
+
+def test_load_fund_links_matches_held_funds_by_the_series_lei_of_their_filing(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=DATED_NPORT, existing_connection=holdings_conn)
+    position = ("Vanguard 500 Index Fund", "Vanguard 500 Index Fund", "549300VFIAXSERIESLEI", "922908710")
+    db_utils.store_fund_holdings("FXAIX", [position + (4.0, None)], holdings_conn)
+
+    assert db_utils.load_fund_link_positions(holdings_conn) == {"FXAIX": [("VFIAX", position, 4.0)]}
+    assert db_utils.load_fund_links(holdings_conn) == {"FXAIX": [("VFIAX", 4.0)]}
+
+
+def test_load_fund_links_resolves_a_series_lei_to_one_share_class(holdings_conn):
+    holdings_conn.executemany("INSERT INTO funds (ticker, lei, content_hash) VALUES (?, '549300VTSMSERIESLEI0', ?)", [("VTI", None), ("VTSAX", "abc")])
+    position = ("Vanguard Total Stock Market Index Fund", "Vanguard Total Stock Market Index Fund", "549300VTSMSERIESLEI0", "922908769")
+    db_utils.store_fund_holdings("VFIAX", [position + (50.0, None)], holdings_conn)
+
+    assert db_utils.load_fund_links(holdings_conn) == {"VFIAX": [("VTSAX", 50.0)]}
+
+    # a CUSIP names the share class itself
+    holdings_conn.execute("UPDATE funds SET cusip = '922908769' WHERE ticker = 'VTI'")
+    assert db_utils.load_fund_links(holdings_conn) == {"VFIAX": [("VTI", 50.0)]}
+
+def test_backfill_reads_each_stored_filings_lei_once(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=DATED_NPORT, existing_connection=holdings_conn)
+    db_utils.update_existing_fund("FXAIX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+    holdings_conn.execute("UPDATE funds SET lei = NULL")
+
+    assert db_utils.backfill_fund_leis(holdings_conn) == 1
+    assert holdings_conn.execute("SELECT ticker, lei FROM funds ORDER BY ticker").fetchall() == [("FXAIX", ""), ("VFIAX", "549300VFIAXSERIESLEI")]
+    with patch("data_scraping_utils.parse_nport_holdings") as mock_parse:
+        assert db_utils.backfill_fund_leis(holdings_conn) == 0
+    mock_parse.assert_not_called()
+
+
+def test_storing_holdings_only_reindexes_that_fund(holdings_conn):
+    db_utils.store_fund_holdings("VFIAX", SAMPLE_HOLDINGS, holdings_conn)
+    db_utils.store_fund_holdings("FXAIX", SAMPLE_HOLDINGS, holdings_conn)
+    db_utils.store_fund_holdings("FXAIX", [("Amazon.com Inc", "Amazon.com Inc", "", "", 4.0, None)], holdings_conn)
+
+    result = db_utils.lookup_company_exposures(["Amazon.com Inc"], ["VFIAX", "FXAIX"], holdings_conn)
+
+    assert result == {"Amazon.com Inc": {"VFIAX": 2.5, "FXAIX": 4.0}}
+
+
+# ─────────────────────────────────────────────
+# store_filing_period() / lookup_exposure_history()
+# ─────────────────────────────────────────────
+
+def test_dated_filing_is_kept_in_the_filing_history(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=DATED_NPORT, existing_connection=holdings_conn)
+
+    assert db_utils.load_filing_periods(["VFIAX", "FXAIX"], existing_connection=holdings_conn) == [("VFIAX", "2025-03-31")]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2025-03-31", holdings_conn) == SAMPLE_HOLDINGS
+
+
+def test_exposure_history_reads_every_period_up_to_end(holdings_conn):
+    amazon = SAMPLE_HOLDINGS[0]
+    db_utils.store_filing_period("VFIAX", "2024-12-31", [amazon[:4] + (2.0, 100.0)], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-03-31", [amazon[:4] + (2.5, 100.0)], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-03-31", [amazon[:4] + (3.0, 100.0)], None, holdings_conn) # amendment
+    db_utils.store_filing_period("FXAIX", "2025-01-31", [amazon[:4] + (1.0, 100.0)], None, holdings_conn)
+
+    result = db_utils.lookup_exposure_history(["AMZN", "Amazon.com Inc"], ["VFIAX", "FXAIX"], "2025-02-28", holdings_conn)
+
+    assert sorted(result["Amazon.com Inc"]) == [("2024-12-31", "VFIAX", 2.0), ("2025-01-31", "FXAIX", 1.0)]
+    assert db_utils.lookup_exposure_history(["Amazon.com Inc"], ["VFIAX"], None, holdings_conn)["Amazon.com Inc"][-1] == ("2025-03-31", "VFIAX", 3.0)
+
+
+def test_filing_history_only_writes_positions_that_changed(holdings_conn):
+    amazon, cash = SAMPLE_HOLDINGS
+    db_utils.store_filing_period("VFIAX", "2024-12-31", [amazon, cash], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-03-31", [amazon[:4] + (3.0, 1800.0), cash], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-06-30", [amazon[:4] + (3.0, 1800.0)], None, holdings_conn)
+
+    ranges = holdings_conn.execute("SELECT name, valid_from, valid_to FROM position_ranges ORDER BY range_id").fetchall()
+    assert ranges == [
+        ("Amazon.com Inc", "2024-12-31", "2025-03-31"),
+        ("Cash Sleeve", "2024-12-31", "2025-06-30"),
+        ("Amazon.com Inc", "2025-03-31", None),
+    ]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2024-12-31", holdings_conn) == [amazon, cash]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2025-03-31", holdings_conn) == [cash, amazon[:4] + (3.0, 1800.0)]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2025-06-30", holdings_conn) == [amazon[:4] + (3.0, 1800.0)]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2025-05-31", holdings_conn) is None
+
+
+def test_filing_history_backfills_periods_older_than_the_latest(holdings_conn):
+    amazon, cash = SAMPLE_HOLDINGS
+    later = amazon[:4] + (3.0, 1800.0)
+    db_utils.store_filing_period("VFIAX", "2025-06-30", [later, cash], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2024-12-31", [amazon], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-03-31", [later], None, holdings_conn)
+    db_utils.store_filing_period("VFIAX", "2025-03-31", [amazon, cash], None, holdings_conn) # amendment
+
+    assert db_utils.load_filing_periods(["VFIAX"], existing_connection=holdings_conn) == [("VFIAX", "2024-12-31"), ("VFIAX", "2025-03-31"), ("VFIAX", "2025-06-30")]
+    assert db_utils.load_filing_period_holdings("VFIAX", "2024-12-31", holdings_conn) == [amazon]
+    assert sorted(db_utils.load_filing_period_holdings("VFIAX", "2025-03-31", holdings_conn)) == sorted([amazon, cash])
+    assert sorted(db_utils.load_filing_period_holdings("VFIAX", "2025-06-30", holdings_conn)) == sorted([later, cash])
+    result = db_utils.lookup_exposure_history(["Amazon.com Inc"], ["VFIAX"], None, holdings_conn)
+    assert result["Amazon.com Inc"] == [("2024-12-31", "VFIAX", 2.5), ("2025-03-31", "VFIAX", 2.5), ("2025-06-30", "VFIAX", 3.0)]
+
+
+def test_backfill_records_filings_stored_before_the_history(holdings_conn):
+    db_utils.update_existing_fund("VFIAX", nport_document=DATED_NPORT, existing_connection=holdings_conn)
+    db_utils.update_existing_fund("FXAIX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+    holdings_conn.execute("DELETE FROM filing_history")
+
+    assert db_utils.backfill_filing_history(holdings_conn) == 1
+    assert db_utils.load_filing_periods(["VFIAX", "FXAIX"], existing_connection=holdings_conn) == [("VFIAX", "2025-03-31")]
+    assert db_utils.backfill_filing_history(holdings_conn) == 0
+
+
+def test_backfill_parses_a_filing_without_a_report_period_once(holdings_conn):
+    db_utils.update_existing_fund("FXAIX", nport_document=SAMPLE_NPORT, existing_connection=holdings_conn)
+
+    with patch("data_scraping_utils.parse_nport_holdings", wraps=data_scraping_utils.parse_nport_holdings) as parse:
+        assert db_utils.backfill_filing_history(holdings_conn) == 0
+        assert db_utils.backfill_filing_history(holdings_conn) == 0
+
+    parse.assert_called_once()
+
+
+# ─────────────────────────────────────────────
+# refresh_all_fund_data()
+# ─────────────────────────────────────────────
+
+def test_refresh_downloads_each_shared_filing_once(holdings_conn, stub_sec_server):
+    holdings_conn.execute("UPDATE funds SET sec_url = ?", (stub_sec_server.url("/shared.txt"),))
+
+    db_utils.refresh_all_fund_data(holdings_conn)
+
+    assert stub_sec_server.requests == ["/shared.txt"]
+    assert db_utils.load_fund_holdings(["VFIAX", "FXAIX"], holdings_conn) == {"VFIAX": SAMPLE_HOLDINGS, "FXAIX": SAMPLE_HOLDINGS}
+    assert db_utils.load_funds_from_cache(["VFIAX", "FXAIX"], holdings_conn) == {"VFIAX": SAMPLE_NPORT, "FXAIX": SAMPLE_NPORT}
+    assert holdings_conn.execute("SELECT COUNT(*) FROM filings").fetchone() == (1,)
+
+
+def test_on_demand_fetch_stores_the_filing_like_refresh(holdings_conn, stub_sec_server):
+    holdings_conn.execute("UPDATE funds SET sec_url = ?", (stub_sec_server.url("/vfiax.txt"),))
+    stub_sec_server.etag = '"v1"'
+
+    assert finance_utils.fetch_missing_holdings("VFIAX", holdings_conn) == SAMPLE_HOLDINGS
+
+    content_hash = hashlib.sha256(SAMPLE_NPORT.encode()).hexdigest()
+    assert holdings_conn.execute("SELECT etag, content_hash FROM funds WHERE ticker = 'VFIAX'").fetchone() == ('"v1"', content_hash)
+    assert db_utils.load_funds_from_cache(["VFIAX"], holdings_conn) == {"VFIAX": SAMPLE_NPORT}
+    assert db_utils.load_fund_holdings(["VFIAX"], holdings_conn) == {"VFIAX": SAMPLE_HOLDINGS}
+
+
+def test_refresh_commits_the_pruned_exposure_results(holdings_conn, stub_sec_server):
+    holdings_conn.execute("UPDATE funds SET sec_url = ?", (stub_sec_server.url("/shared.txt"),))
+    holdings_conn.execute("INSERT INTO exposure_results (cache_key, funds, exposures, created) VALUES ('old', '[]', '{}', '2000-01-01')")
+    holdings_conn.commit()
+
+    db_utils.refresh_all_fund_data(holdings_conn)
+
+    assert not holdings_conn.in_transaction
+    assert holdings_conn.execute("SELECT COUNT(*) FROM exposure_results").fetchone() == (0,)
+
+
+def test_refresh_skips_rewriting_unchanged_filings(holdings_conn, stub_sec_server):
+    holdings_conn.execute("UPDATE funds SET sec_url = ?", (stub_sec_server.url("/shared.txt"),))
+    db_utils.refresh_all_fund_data(holdings_conn)
+    holdings_conn.execute("UPDATE funds SET last_updated = NULL")
+
+    with patch("db_utils.store_fund_holdings") as mock_store:
+        db_utils.refresh_all_fund_data(holdings_conn)
+
+    mock_store.assert_not_called()
+    assert stub_sec_server.requests == ["/shared.txt", "/shared.txt"]
+    assert holdings_conn.execute("SELECT COUNT(*) FROM funds WHERE last_updated IS NULL").fetchone() == (0,)
+
+
+def test_refresh_uses_stored_etag_for_conditional_requests(holdings_conn, stub_sec_server):
+    stub_sec_server.etag = '"v1"'
+    holdings_conn.execute("UPDATE funds SET sec_url = ?", (stub_sec_server.url("/shared.txt"),))
+    db_utils.refresh_all_fund_data(holdings_conn)
+    holdings_conn.execute("UPDATE funds SET last_updated = NULL")
+
+    with patch("data_scraping_utils.iter_nport_holdings") as mock_parse, \
+         patch("db_utils.store_fund_holdings") as mock_store:
+        db_utils.refresh_all_fund_data(holdings_conn)
+
+    mock_parse.assert_not_called()
+    mock_store.assert_not_called()
+    assert holdings_conn.execute("SELECT DISTINCT etag FROM funds").fetchall() == [('"v1"',)]
+
+
+def test_refresh_skips_funds_with_fresh_holdings(holdings_conn):
+    holdings_conn.execute("UPDATE funds SET sec_url = 'http://sec.gov/test'")
+    db_utils.update_existing_fund("VFIAX", existing_connection=holdings_conn, holdings=SAMPLE_HOLDINGS)
+    db_utils.update_existing_fund("FXAIX", existing_connection=holdings_conn, holdings=SAMPLE_HOLDINGS)
+
+    with patch("data_scraping_utils.fetch_holdings_concurrently") as mock_fetch:
+        db_utils.refresh_all_fund_data(holdings_conn)
+
+    mock_fetch.assert_not_called()
 
 
 # ─────────────────────────────────────────────
@@ -120,27 +903,28 @@ def test_update_fund_no_op_when_no_fields_given(mock_conn):
     mock_conn.cursor().execute.assert_not_called()
 
 
-@pytest.mark.parametrize("field,value", [
-    ("sec_url", "http://new.url"),
-    ("nport_document", "<nport/>"),
+@pytest.mark.parametrize("field,value,column", [
+    ("sec_url", "http://new.url", "sec_url"),
+    ("nport_document", "<nport/>", "content_hash"),
 ])
-def test_update_fund_generates_correct_sql(mock_conn, field, value):
+def test_update_fund_generates_correct_sql(mock_conn, field, value, column):
     kwargs = {field: value, "existing_connection": mock_conn}
     db_utils.update_existing_fund("VFIAX", **kwargs)
 
     query = mock_conn.cursor().execute.call_args[0][0]
     assert "UPDATE funds SET" in query
-    assert field in query
+    assert column in query
 
 
-def test_update_fund_closes_internally_created_connection():
+def test_update_fund_keeps_shared_connection_open():
     mock_conn = MagicMock()
     mock_conn.cursor.return_value = MagicMock()
 
-    with patch("db_utils.connect", return_value=mock_conn):
+    with patch("db_utils.get_connection", return_value=mock_conn):
         db_utils.update_existing_fund("VFIAX", sec_url="http://x.com")
 
-    mock_conn.close.assert_called_once()
+    mock_conn.commit.assert_called_once()
+    mock_conn.close.assert_not_called()
 
 
 def test_update_fund_does_not_close_external_connection(mock_conn):
@@ -194,3 +978,104 @@ def test_delete_user_portfolio_raises_on_none_user():
 def test_delete_user_portfolio_executes_query(mock_conn):
     db_utils.delete_user_portfolio(1, existing_connection=mock_conn)
     mock_conn.cursor().execute.assert_called_once()
+
+
+# ─────────────────────────────────────────────
+# import_portfolio_positions() / export
+# ─────────────────────────────────────────────
+
+@pytest.fixture
+def portfolios_conn():
+    conn = sqlite3.connect(":memory:")
+    db_utils.migrate_schema(conn)
+    yield conn
+    conn.close()
+
+
+def test_read_portfolio_file_maps_columns_by_header(tmp_path):
+    path = tmp_path / "portfolios.csv"
+    path.write_text("fund,amount,user\nVFIAX,100,1\nFXAIX,5,2\n")
+
+    assert list(db_utils.read_portfolio_file(str(path))) == [("1", "VFIAX", "100"), ("2", "FXAIX", "5")]
+
+
+def test_read_portfolio_file_rejects_missing_columns(tmp_path):
+    path = tmp_path / "portfolios.csv"
+    path.write_text("fund,amount\nVFIAX,100\n")
+
+    with pytest.raises(ValueError):
+        list(db_utils.read_portfolio_file(str(path)))
+
+
+def test_import_portfolios_batches_rows_and_skips_invalid_ones(portfolios_conn):
+    rows = [("1", "VFIAX", "100"), ("1", "", "5"), ("2", "FXAIX", "ten"), ("2", "FXAIX", "20"), ("3", "QQQ", "7")]
+
+    with patch("db_utils.PORTFOLIO_BATCH_SIZE", 2):
+        imported, rejected = db_utils.import_portfolio_positions(rows, existing_connection=portfolios_conn)
+
+    assert imported == 3
+    assert [row_number for row_number, row, reason in rejected] == [2, 3]
+    assert db_utils.load_portfolios(None, portfolios_conn) == [(1, "VFIAX", 100), (2, "FXAIX", 20), (3, "QQQ", 7)]
+    indexes = portfolios_conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    assert ("idx_portfolios_user_fund_amount",) in indexes
+
+
+def test_import_portfolios_converts_csv_text_and_explains_rejected_rows(portfolios_conn):
+    rows = [("1", " VFIAX ", "100"), ("2", None, "5"), ("x", "FXAIX", "1"), ("3", "QQQ", "1.5")]
+
+    imported, rejected = db_utils.import_portfolio_positions(rows, existing_connection=portfolios_conn)
+
+    assert imported == 1
+    assert rejected == [
+        (2, ("2", None, "5"), "fund cannot be null"),
+        (3, ("x", "FXAIX", "1"), "user is not an integer: 'x'"),
+        (4, ("3", "QQQ", "1.5"), "amount is not an integer: 1.5"),
+    ]
+    assert db_utils.load_portfolios(None, portfolios_conn) == [(1, "VFIAX", 100)]
+    assert portfolios_conn.execute("SELECT name FROM sqlite_temp_master").fetchall() == []
+
+
+def test_import_portfolios_keeps_the_index_for_imports_smaller_than_the_table(portfolios_conn):
+    db_utils.import_portfolio_positions([(user, "VFIAX", 1) for user in range(1, 7)], existing_connection=portfolios_conn)
+    statements = []
+    portfolios_conn.set_trace_callback(statements.append)
+
+    with patch("db_utils.PORTFOLIO_BATCH_SIZE", 2), patch("db_utils.PORTFOLIO_INDEX_REBUILD_MIN_ROWS", 2):
+        imported, rejected = db_utils.import_portfolio_positions([(7, "QQQ", 1), (8, "QQQ", 2), (9, "QQQ", 3)], existing_connection=portfolios_conn)
+
+    assert (imported, rejected) == (3, [])
+    assert not any(statement.startswith("DROP INDEX") for statement in statements)
+
+
+def test_import_portfolios_rebuilds_the_index_once_the_import_outgrows_the_table(portfolios_conn):
+    db_utils.import_portfolio_positions([(1, "VFIAX", 1)], existing_connection=portfolios_conn)
+    statements = []
+    portfolios_conn.set_trace_callback(statements.append)
+
+    with patch("db_utils.PORTFOLIO_BATCH_SIZE", 2), patch("db_utils.PORTFOLIO_INDEX_REBUILD_MIN_ROWS", 2):
+        imported, rejected = db_utils.import_portfolio_positions([(user, "QQQ", 1) for user in range(2, 8)], existing_connection=portfolios_conn)
+
+    assert (imported, rejected) == (6, [])
+    assert sum(statement.startswith("DROP INDEX") for statement in statements) == 1
+    indexes = portfolios_conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    assert ("idx_portfolios_user_fund_amount",) in indexes
+
+
+def test_load_portfolios_reads_more_users_than_one_statement_can_bind(portfolios_conn):
+    db_utils.import_portfolio_positions([(user, "VFIAX", user) for user in range(1, 51)], existing_connection=portfolios_conn)
+    portfolios_conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 16)
+
+    with patch("db_utils.PORTFOLIO_QUERY_CHUNK_SIZE", 16):
+        portfolios = db_utils.load_portfolios(list(range(1, 51)) + [7], portfolios_conn)
+
+    assert sorted(portfolios) == [(user, "VFIAX", user) for user in range(1, 51)]
+
+def test_export_then_import_portfolios_round_trips(portfolios_conn, tmp_path):
+    db_utils.import_portfolio_positions([(1, "VFIAX", 100), (2, "FXAIX", 5)], existing_connection=portfolios_conn)
+    path = str(tmp_path / "portfolios.csv")
+
+    with patch("db_utils.PORTFOLIO_BATCH_SIZE", 1):
+        written = db_utils.write_portfolio_file(path, db_utils.iter_portfolio_positions(portfolios_conn))
+
+    assert written == 2
+    assert list(db_utils.read_portfolio_file(path)) == [("1", "VFIAX", "100"), ("2", "FXAIX", "5")]
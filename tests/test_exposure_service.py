@@ -0,0 +1,127 @@
+import asyncio
+import json
+import pytest
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import db_utils
+import exposure_service
+import service_client
+
+
+# ─────────────────────────────────────────────
+# handle_request()
+# ─────────────────────────────────────────────
+
+def request(method, params=None, request_id=7):
+    return json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params if params is not None else []})
+
+
+@patch("exposure_service.finance_utils.compute_exposures", return_value={"Amazon.com Inc": 250.0})
+def test_request_calls_method_with_positional_params(mock_compute):
+    response = exposure_service.handle_request(request("exposures", [1, ["Amazon.com Inc"], "thread"]))
+
+    assert response == {"jsonrpc": "2.0", "id": 7, "result": {"Amazon.com Inc": 250.0}}
+    mock_compute.assert_called_once_with(1, ["Amazon.com Inc"], engine="thread")
+
+
+@patch("exposure_service.matrix_utils.calculate_all_exposures", return_value=[("Apple Inc", 70.0)])
+def test_request_calls_method_with_keyword_params(mock_calculate):
+    response = exposure_service.handle_request(request("exposures_all", {"user_id": 1, "top_n": 1}))
+
+    assert response["result"] == [("Apple Inc", 70.0)]
+    mock_calculate.assert_called_once_with(1, 1)
+
+
+def test_request_errors_follow_json_rpc_codes():
+    assert exposure_service.handle_request(b"{not json")["error"]["code"] == exposure_service.PARSE_ERROR
+    assert exposure_service.handle_request(b"[]")["error"]["code"] == exposure_service.INVALID_REQUEST
+    assert exposure_service.handle_request(request("drop_tables"))["error"]["code"] == exposure_service.METHOD_NOT_FOUND
+    assert exposure_service.handle_request(request("exposures", [1, ["Amazon.com Inc"], "bad"]))["error"]["code"] == exposure_service.INVALID_PARAMS
+    assert exposure_service.handle_request(request("portfolio", []))["error"]["code"] == exposure_service.INVALID_PARAMS
+
+
+@pytest.mark.parametrize("method,params", [
+    ("exposures", [1, "Amazon.com Inc"]),
+    ("exposures", {"user_id": "1", "companies": ["Amazon.com Inc"]}),
+    ("exposures_all", [1, "10"]),
+    ("exposure_history", [1, ["Amazon.com Inc"], "last year"]),
+    ("portfolio", [1, 2]),
+    ("portfolio", {"user": 1}),
+    ("stats", "all"),
+])
+def test_request_params_are_checked_before_the_method_runs(method, params):
+    with patch.dict(exposure_service.METHODS, {method: lambda *args, **kwargs: pytest.fail("method ran")}):
+        error = exposure_service.handle_request(request(method, params))["error"]
+
+    assert error["code"] == exposure_service.INVALID_PARAMS
+
+
+@patch("exposure_service.db_utils.load_user_portfolio", side_effect=TypeError("unsupported operand"))
+def test_type_errors_raised_inside_a_method_are_server_errors(_):
+    assert exposure_service.handle_request(request("portfolio", [1]))["error"]["code"] == exposure_service.SERVER_ERROR
+
+
+@patch("exposure_service.db_utils.load_user_portfolio", side_effect=RuntimeError("database is locked"))
+def test_request_reports_failures_as_server_errors(_):
+    error = exposure_service.handle_request(request("portfolio", [1]))["error"]
+
+    assert error["code"] == exposure_service.SERVER_ERROR
+    assert "database is locked" in error["message"]
+
+
+# ─────────────────────────────────────────────
+# warm_caches()
+# ─────────────────────────────────────────────
+
+@patch("exposure_service.db_utils.get_connection")
+@patch("exposure_service.db_utils.companies_table_state", return_value=(1, 1))
+@patch("exposure_service.db_utils.load_company_identifiers", return_value={"AMZN": [("Amazon.com Inc", "Amazon.com Inc", "", "", "0001018724")]})
+@patch("exposure_service.db_utils.load_parsed_funds", return_value={"VFIAX": True, "FXAIX": False})
+@patch("exposure_service.db_utils.load_fund_holdings", return_value={"VFIAX": []})
+def test_warm_caches_loads_parsed_funds_and_companies(mock_load_holdings, *_):
+    try:
+        assert exposure_service.warm_caches() == {"funds": 1, "company_identifiers": 1}
+        assert exposure_service.db_utils.COMPANY_IDENTIFIERS is not None
+        assert mock_load_holdings.call_args[0][0] == ["VFIAX"]
+    finally:
+        exposure_service.db_utils.invalidate_company_identifiers()
+
+
+
+def test_warm_caches_does_not_keep_a_write_transaction_open(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "finance_data.db"))
+    db_utils.migrate_schema(conn)
+    conn.execute("INSERT INTO exposure_results (cache_key, funds, exposures, created) VALUES ('old', '[]', '{}', '2000-01-01')")
+    conn.commit()
+
+    try:
+        exposure_service.warm_caches(conn)
+    finally:
+        exposure_service.db_utils.invalidate_company_identifiers()
+
+    assert not conn.in_transaction
+    other = sqlite3.connect(str(tmp_path / "finance_data.db"), timeout=0)
+    other.execute("INSERT INTO funds (ticker) VALUES ('NEW')")
+    other.commit()
+    assert conn.execute("SELECT COUNT(*) FROM exposure_results").fetchone() == (0,)
+
+# ─────────────────────────────────────────────
+# service over a socket
+# ─────────────────────────────────────────────
+
+def test_client_talks_to_a_running_service():
+    async def exchange():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            server = await asyncio.start_server(
+                lambda reader, writer: exposure_service.handle_connection(reader, writer, executor), "127.0.0.1", 0
+            )
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                pong = await asyncio.to_thread(service_client.call, "ping", None, "127.0.0.1", port)
+                with pytest.raises(service_client.ServiceError) as error:
+                    await asyncio.to_thread(service_client.call, "drop_tables", None, "127.0.0.1", port)
+            return pong, error.value.code
+
+    assert asyncio.run(exchange()) == ("pong", exposure_service.METHOD_NOT_FOUND)
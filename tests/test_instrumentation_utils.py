@@ -0,0 +1,162 @@
+import json
+import threading
+import pytest
+
+import instrumentation_utils
+
+
+# ─────────────────────────────────────────────
+# Fixtures
+# ─────────────────────────────────────────────
+
+@pytest.fixture(autouse=True)
+def empty_measurements():
+    """Every test starts without recorded spans, counters or profiles."""
+    instrumentation_utils.reset()
+    yield
+    instrumentation_utils.reset()
+    instrumentation_utils.PROFILED_SPANS.clear()
+
+
+# ─────────────────────────────────────────────
+# span()
+# ─────────────────────────────────────────────
+
+def test_span_records_calls_and_elapsed_time():
+    with instrumentation_utils.span("match") as timing:
+        pass
+    with instrumentation_utils.span("match"):
+        pass
+
+    spans = instrumentation_utils.snapshot()["spans"]
+    assert spans["match"]["calls"] == 2
+    assert timing.elapsed >= 0
+    assert spans["match"]["max_seconds"] <= spans["match"]["total_seconds"]
+
+
+def test_nested_spans_are_recorded_under_their_parent():
+    with instrumentation_utils.span("compute_exposures"):
+        with instrumentation_utils.span("match"):
+            assert instrumentation_utils.current_span() == "compute_exposures/match"
+
+    assert set(instrumentation_utils.snapshot()["spans"]) == {"compute_exposures", "compute_exposures/match"}
+    assert instrumentation_utils.current_span() is None
+
+
+def test_span_decorator_times_every_call_and_keeps_the_result():
+    @instrumentation_utils.span("db.load_portfolios")
+    def load():
+        return [(1, "VFIAX", 10)]
+
+    assert load() == [(1, "VFIAX", 10)]
+    assert load.__name__ == "load"
+    load()
+
+    assert instrumentation_utils.snapshot()["spans"]["db.load_portfolios"]["calls"] == 2
+
+
+def test_span_is_recorded_when_the_body_raises():
+    with pytest.raises(ValueError):
+        with instrumentation_utils.span("parse"):
+            raise ValueError("bad filing")
+
+    assert instrumentation_utils.snapshot()["spans"]["parse"]["calls"] == 1
+    assert instrumentation_utils.current_span() is None
+
+
+def test_spans_on_other_threads_do_not_nest_under_this_one():
+    def worker():
+        with instrumentation_utils.span("scan"):
+            pass
+
+    with instrumentation_utils.span("match"):
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert instrumentation_utils.snapshot()["spans"]["scan"]["calls"] == 8
+
+
+# ─────────────────────────────────────────────
+# increment()
+# ─────────────────────────────────────────────
+
+def test_counters_are_safe_to_increment_from_many_threads():
+    def worker():
+        for _ in range(1000):
+            instrumentation_utils.increment("positions_scanned")
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    instrumentation_utils.increment("bytes_downloaded", 65536)
+
+    assert instrumentation_utils.snapshot()["counters"] == {"bytes_downloaded": 65536, "positions_scanned": 8000}
+
+
+# ─────────────────────────────────────────────
+# profiling
+# ─────────────────────────────────────────────
+
+def test_profiled_span_keeps_a_cprofile_report():
+    instrumentation_utils.PROFILED_SPANS.add("exposures")
+
+    with instrumentation_utils.span("exposures"):
+        sorted(range(1000))
+
+    assert "function calls" in instrumentation_utils.snapshot()["profiles"]["exposures"]
+
+
+def test_profiled_span_inside_a_profiled_span_is_only_timed():
+    instrumentation_utils.PROFILED_SPANS.update({"exposures", "match"})
+
+    with instrumentation_utils.span("exposures"):
+        with instrumentation_utils.span("match"):
+            pass
+
+    measurements = instrumentation_utils.snapshot()
+    assert set(measurements["profiles"]) == {"exposures"}
+    assert measurements["spans"]["exposures/match"]["calls"] == 1
+
+
+# ─────────────────────────────────────────────
+# exports
+# ─────────────────────────────────────────────
+
+def test_export_profiles_prints_each_profiled_span_report():
+    instrumentation_utils.PROFILED_SPANS.add("exposures")
+
+    with instrumentation_utils.span("exposures"):
+        sorted(range(1000))
+
+    exported = instrumentation_utils.export_profiles()
+    assert exported.startswith("cProfile report of exposures\n")
+    assert "function calls" in exported
+
+
+
+def test_export_json_round_trips_the_snapshot():
+    with instrumentation_utils.span("match"):
+        instrumentation_utils.increment("holdings_cache_hits", 3)
+
+    exported = json.loads(instrumentation_utils.export_json())
+
+    assert exported["counters"] == {"holdings_cache_hits": 3}
+    assert exported["spans"]["match"]["calls"] == 1
+
+
+def test_export_prometheus_labels_spans_and_sanitizes_counter_names():
+    with instrumentation_utils.span("compute_exposures"):
+        with instrumentation_utils.span("db.load_fund_holdings"):
+            pass
+    instrumentation_utils.increment("bytes.downloaded", 10)
+
+    text = instrumentation_utils.export_prometheus()
+
+    assert '# TYPE investment_dashboard_span_seconds_total counter' in text
+    assert 'investment_dashboard_span_calls_total{span="compute_exposures/db.load_fund_holdings"} 1' in text
+    assert "investment_dashboard_bytes_downloaded_total 10" in text
@@ -0,0 +1,43 @@
+import pytest
+
+import matching_utils
+
+
+# ─────────────────────────────────────────────
+# NameMatcher
+# ─────────────────────────────────────────────
+
+def test_matcher_finds_queries_as_whole_words_only():
+    matcher = matching_utils.NameMatcher(["Meta", "Amazon"])
+
+    assert matcher.matches("Meta Platforms Inc") == {"Meta"}
+    assert matcher.matches("Metals Corp") == set()
+    assert matcher.matches("AMAZON.COM, INC.") == {"Amazon"}
+
+
+def test_matcher_reports_overlapping_and_nested_queries():
+    matcher = matching_utils.NameMatcher(["Bank of America Corp", "America", "Bank"])
+
+    assert matcher.matches("BANK OF AMERICA CORP") == {"Bank of America Corp", "America", "Bank"}
+    assert matcher.matches("Americas Bank") == {"Bank"}
+
+
+def test_matcher_follows_failure_links_across_partial_matches():
+    matcher = matching_utils.NameMatcher(["ab ab c", "b ab"])
+
+    assert matcher.matches("ab ab ab c") == {"ab ab c"}
+    assert matcher.matches("x b ab y") == {"b ab"}
+
+
+def test_matcher_normalizes_queries_like_company_scrape():
+    matcher = matching_utils.NameMatcher(["Apple Inc.", "", "Inc"])
+
+    assert matcher.matches("apple") == {"Apple Inc."}
+
+
+def test_matcher_handles_many_queries_in_one_pass():
+    companies = [f"Company {i}" for i in range(500)]
+    matcher = matching_utils.NameMatcher(companies)
+
+    assert matcher.matches("Company 42 Holdings") == {"Company 42"}
+    assert matcher.matches("Company 4") == {"Company 4"}
@@ -0,0 +1,206 @@
+import os
+import pytest
+import numpy as np
+from unittest.mock import patch, MagicMock
+
+import matrix_utils
+
+
+# [ name, title, lei, cusip, pct_val, val_usd ]
+FUND_HOLDINGS = {
+    "VFIAX": [
+        ("Amazon.com Inc", "Amazon.com Inc", "ZXTILKJKG63JELOEG630", "023135106", 2.5, None),
+        ("Apple Inc", "Apple Inc", "", "037833100", 7.0, None),
+        ("Cash Sleeve", "Cash Sleeve", "", "", None, None),
+    ],
+    "FXAIX": [
+        ("AMAZON.COM INC", "AMAZON.COM INC", "ZXTILKJKG63JELOEG630", "", 2.0, None),
+        ("Netflix Inc", "Netflix Inc", "", "", 1.0, None),
+    ],
+}
+
+
+# ─────────────────────────────────────────────
+# build_weight_matrix()
+# ─────────────────────────────────────────────
+
+def test_weight_matrix_merges_companies_across_funds_by_identifier():
+    fund_rows, labels, matrix = matrix_utils.build_weight_matrix(FUND_HOLDINGS)
+
+    assert fund_rows == {"VFIAX": 0, "FXAIX": 1}
+    assert labels == ["Amazon.com Inc", "Apple Inc", "Netflix Inc"]
+    assert matrix.tolist() == [[2.5, 7.0, 0.0], [2.0, 0.0, 1.0]]
+
+
+def test_weight_matrix_gives_unparsed_funds_an_empty_row():
+    fund_rows, labels, matrix = matrix_utils.build_weight_matrix({"VFIAX": None})
+
+    assert matrix.shape == (1, 0)
+
+
+def test_weight_matrix_from_cached_columns_matches_holding_tuples(tmp_path):
+    for fund, holdings in FUND_HOLDINGS.items():
+        matrix_utils.write_holdings_cache(fund.lower(), holdings, str(tmp_path))
+    cached = {fund: matrix_utils.load_holdings_cache(fund.lower(), str(tmp_path)) for fund in FUND_HOLDINGS}
+
+    assert isinstance(cached["VFIAX"]["pct_val"], np.memmap)
+    assert [str(key) for key in cached["VFIAX"]["keys"]] == ["lei:ZXTILKJKG63JELOEG630", "cusip:037833100", "name:cash sleeve"]
+
+    fund_rows, labels, matrix = matrix_utils.build_weight_matrix(cached)
+    expected_rows, expected_labels, expected_matrix = matrix_utils.build_weight_matrix(FUND_HOLDINGS)
+    assert (fund_rows, labels) == (expected_rows, expected_labels)
+    assert matrix.tolist() == expected_matrix.tolist()
+
+
+# ─────────────────────────────────────────────
+# populate_holdings_cache() / load_fund_columns()
+# ─────────────────────────────────────────────
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value={"VFIAX": FUND_HOLDINGS["VFIAX"], "FXAIX": None})
+@patch("matrix_utils.db_utils.load_fund_content_hashes", return_value={"VFIAX": "abc", "VOO": "abc", "FXAIX": "def"})
+def test_populate_cache_writes_each_parsed_filing_once_and_prunes_old_entries(_, mock_load, tmp_path):
+    (tmp_path / "stale").mkdir()
+
+    written = matrix_utils.populate_holdings_cache(str(tmp_path), MagicMock())
+
+    assert written == 1
+    assert sorted(mock_load.call_args[0][0]) == ["FXAIX", "VFIAX"]
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ["abc"]
+
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value={})
+@patch("matrix_utils.db_utils.load_fund_content_hashes", return_value={"VFIAX": "abc"})
+def test_populate_cache_leaves_another_process_staging_directory_alone(_, __, tmp_path):
+    (tmp_path / "abc").mkdir()
+    (tmp_path / "def.tmp-4242").mkdir()
+    (tmp_path / "ghi.tmp-4243").mkdir()
+    os.utime(tmp_path / "ghi.tmp-4243", (0, 0))
+
+    matrix_utils.populate_holdings_cache(str(tmp_path), MagicMock())
+
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ["abc", "def.tmp-4242"]
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value={"FXAIX": FUND_HOLDINGS["FXAIX"]})
+@patch("matrix_utils.db_utils.load_fund_content_hashes", return_value={"VFIAX": "abc", "FXAIX": "def"})
+def test_load_fund_columns_prefers_cache_and_falls_back_to_database(_, mock_load, tmp_path):
+    matrix_utils.write_holdings_cache("abc", FUND_HOLDINGS["VFIAX"], str(tmp_path))
+
+    with patch("matrix_utils.HOLDINGS_CACHE_DIR", str(tmp_path)):
+        result = matrix_utils.load_fund_columns(["VFIAX", "FXAIX"], MagicMock())
+
+    mock_load.assert_called_once_with(["FXAIX"], mock_load.call_args[0][1])
+    assert list(result["VFIAX"]["pct_val"][:2]) == [2.5, 7.0]
+    assert result["FXAIX"] == FUND_HOLDINGS["FXAIX"]
+
+
+def test_look_through_weights_folds_held_fund_rows_into_holders():
+    fund_rows, labels, matrix = matrix_utils.build_weight_matrix({"TARGET": [("Apple Inc", "Apple Inc", "", "037833100", 1.0, None)], **FUND_HOLDINGS})
+    order = ["VFIAX", "FXAIX", "TARGET"]
+
+    matrix_utils.look_through_weights(matrix, fund_rows, order, {"VFIAX": [], "FXAIX": [], "TARGET": [("VFIAX", 50.0), ("MISSING", 10.0)]})
+
+    # Apple: 1 + 50% of 7, Amazon: 50% of 2.5
+    assert dict(zip(labels, matrix[fund_rows["TARGET"]].tolist())) == {"Apple Inc": 4.5, "Amazon.com Inc": 1.25, "Netflix Inc": 0.0}
+
+
+def test_look_through_replaces_the_position_in_the_held_fund_without_changing_the_total():
+    position = ("Vanguard 500 Index Fund", "Vanguard 500 Index Fund", "", "922908710")
+    fund_holdings = {
+        "VFIAX": [("Amazon.com Inc", "Amazon.com Inc", "", "023135106", 40.0, None), ("Apple Inc", "Apple Inc", "", "037833100", 60.0, None)],
+        "TARGET": [position + (50.0, None), ("Apple Inc", "Apple Inc", "", "037833100", 50.0, None)],
+    }
+    company_columns = {}
+    fund_rows, labels, matrix = matrix_utils.build_weight_matrix(fund_holdings, company_columns)
+    link_positions = {"TARGET": [("VFIAX", position, 50.0)]}
+
+    matrix_utils.look_through_weights(
+        matrix, fund_rows, ["VFIAX", "TARGET"], {"VFIAX": [], "TARGET": [("VFIAX", 50.0)]},
+        matrix_utils.held_fund_columns(link_positions, company_columns)
+    )
+
+    # Apple: 50 + 50% of 60, Amazon: 50% of 40, the fund position itself is gone
+    assert dict(zip(labels, matrix[fund_rows["TARGET"]].tolist())) == {"Amazon.com Inc": 20.0, "Apple Inc": 80.0, "Vanguard 500 Index Fund": 0.0}
+    assert matrix[fund_rows["TARGET"]].sum() == 100.0
+
+
+# ─────────────────────────────────────────────
+# top_exposures()
+# ─────────────────────────────────────────────
+
+def test_top_exposures_orders_and_limits_nonzero_values():
+    vector = np.array([1.0, 0.0, 5.5, 3.0])
+
+    assert matrix_utils.top_exposures(vector, ["A", "B", "C", "D"]) == [("C", 5.5), ("D", 3.0), ("A", 1.0)]
+    assert matrix_utils.top_exposures(vector, ["A", "B", "C", "D"], top_n=2) == [("C", 5.5), ("D", 3.0)]
+
+
+# ─────────────────────────────────────────────
+# calculate_all_exposures_many()
+# ─────────────────────────────────────────────
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value=dict(FUND_HOLDINGS))
+@patch("matrix_utils.db_utils.load_portfolios", return_value=[(1, "VFIAX", 100), (1, "FXAIX", 200), (2, "FXAIX", 10)])
+def test_all_exposures_are_one_product_per_user_block(*_):
+    result = matrix_utils.calculate_all_exposures_many(None, existing_connection=MagicMock())
+
+    # Amazon: 2.5 * 100 + 2.0 * 200 = 650
+    assert result[1] == [("Apple Inc", 700.0), ("Amazon.com Inc", 650.0), ("Netflix Inc", 200.0)]
+    assert result[2] == [("Amazon.com Inc", 20.0), ("Netflix Inc", 10.0)]
+
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value={
+    "TARGET": [("Vanguard 500 Index Fund", "", "LEI-VFIAX", "", 50.0, None), ("Apple Inc", "Apple Inc", "", "037833100", 50.0, None)],
+    "VFIAX": FUND_HOLDINGS["VFIAX"],
+})
+@patch("matrix_utils.db_utils.load_fund_link_positions", return_value={"TARGET": [("VFIAX", ("Vanguard 500 Index Fund", "", "LEI-VFIAX", ""), 50.0)]})
+@patch("matrix_utils.db_utils.load_portfolios", return_value=[(1, "TARGET", 10)])
+def test_all_exposures_do_not_count_looked_through_fund_positions_twice(*_):
+    result = matrix_utils.calculate_all_exposures(1, existing_connection=MagicMock())
+
+    # Apple: (50 + 50% of 7) * 10, Amazon: 50% of 2.5 * 10, no separate line for the fund position
+    assert result == [("Apple Inc", 535.0), ("Amazon.com Inc", 12.5)]
+
+
+@patch("matrix_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+@patch("matrix_utils.db_utils.load_portfolios", return_value=[(1, "VFIAX", 100)])
+def test_all_exposures_fetches_unparsed_funds(*_):
+    conn = MagicMock()
+    with patch("matrix_utils.finance_utils.fetch_missing_holdings", return_value=FUND_HOLDINGS["VFIAX"]) as mock_fetch:
+        result = matrix_utils.calculate_all_exposures(1, top_n=1, existing_connection=conn)
+
+    mock_fetch.assert_called_once_with("VFIAX", conn)
+    assert result == [("Apple Inc", 700.0)]
+
+
+# ─────────────────────────────────────────────
+# calculate_exposure_history()
+# ─────────────────────────────────────────────
+
+@patch("matrix_utils.db_utils.lookup_exposure_history", return_value={
+    "Amazon.com Inc": [("2024-12-31", "VFIAX", 2.0), ("2025-03-31", "VFIAX", 3.0), ("2025-01-31", "FXAIX", 1.0)],
+})
+@patch("matrix_utils.db_utils.load_filing_periods", return_value=[
+    ("VFIAX", "2024-12-31"), ("FXAIX", "2025-01-31"), ("VFIAX", "2025-03-31"), ("FXAIX", "2025-04-30"),
+])
+@patch("matrix_utils.db_utils.load_fund_links", return_value={})
+@patch("matrix_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("FXAIX", 200)])
+def test_exposure_history_carries_each_funds_latest_filing_forward(*_):
+    result = matrix_utils.calculate_exposure_history(1, ["Amazon.com Inc"], existing_connection=MagicMock())
+
+    # FXAIX files a month after VFIAX and drops Amazon in April, VFIAX's March weight carries into April
+    assert result == {"Amazon.com Inc": [("2024-12-31", 200.0), ("2025-01-31", 400.0), ("2025-03-31", 500.0), ("2025-04-30", 300.0)]}
+
+
+@patch("matrix_utils.db_utils.lookup_exposure_history", return_value={"Amazon.com Inc": [("2025-03-31", "VFIAX", 2.0), ("2025-06-30", "VFIAX", 2.0)]})
+@patch("matrix_utils.db_utils.load_filing_periods", return_value=[("VFIAX", "2025-03-31"), ("FOF", "2025-06-30"), ("VFIAX", "2025-06-30")])
+@patch("matrix_utils.db_utils.load_fund_links", return_value={"FOF": [("VFIAX", 50.0)]})
+@patch("matrix_utils.db_utils.load_user_portfolio", return_value=[("FOF", 10)])
+def test_exposure_history_looks_through_held_funds_once_the_holder_has_filed(*_):
+    result = matrix_utils.calculate_exposure_history(1, ["Amazon.com Inc"], existing_connection=MagicMock())
+
+    # FOF's first filing is June, so March shows nothing for it: 50% of VFIAX's 2.0 * 10 shares after that
+    assert result == {"Amazon.com Inc": [("2025-03-31", 0.0), ("2025-06-30", 10.0)]}
+
+    assert matrix_utils.calculate_exposure_history(1, ["Amazon.com Inc"], start="2025-04-01", existing_connection=MagicMock()) == {
+        "Amazon.com Inc": [("2025-06-30", 10.0)]
+    }
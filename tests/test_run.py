@@ -5,6 +5,7 @@ from unittest.mock import patch, MagicMock
 
 import finance_utils
 import db_utils
+import instrumentation_utils
 import data_scraping_utils
 
 
@@ -15,124 +16,348 @@ import data_scraping_utils
 @pytest.fixture(autouse=True)
 def reset_finance_utils_globals():
     """Reset all mutable finance_utils.py globals before each test."""
-    finance_utils.START_TIME = None
-    finance_utils.END_TIME = None
-    finance_utils.FUNDS = {}
+    finance_utils.COMPANIES_TO_SEARCH_KEYS = ["Amazon.com Inc", "Another NA Company", "Netflix", "NA-Company!"]
     finance_utils.COMPANIES_TO_SEARCH = dict.fromkeys(finance_utils.COMPANIES_TO_SEARCH_KEYS, 0.0)
     yield
 
 
-SAMPLE_NPORT = """
-<invstOrSec>
-    <n>Amazon.com Inc</n>
-    <pctVal>2.5</pctVal>
-</invstOrSec>
-<invstOrSec>
-    <n>Apple Inc</n>
-    <pctVal>7.0</pctVal>
-</invstOrSec>
-"""
+@pytest.fixture(autouse=True)
+def no_memoized_exposures():
+    """Exposure calculations miss the result cache unless a test says otherwise."""
+    with patch("finance_utils.db_utils.load_exposure_result", return_value=None), \
+         patch("finance_utils.db_utils.store_exposure_result"):
+        yield
 
 
-# ─────────────────────────────────────────────
-# calculate_company_exposures_for_fund()
-# ─────────────────────────────────────────────
+# [ name, title, lei, cusip, pct_val, val_usd ]
+SAMPLE_HOLDINGS = [
+    ("Amazon.com Inc", "Amazon.com Inc", "", "", 2.5, None),
+    ("Apple Inc", "Apple Inc", "", "", 7.0, None),
+]
 
-def test_exposures_skips_fund_not_in_funds_dict():
-    finance_utils.FUNDS = {}
-    finance_utils.calculate_company_exposures_for_fund("MISSING", 100)
-    assert all(v == 0.0 for v in finance_utils.COMPANIES_TO_SEARCH.values())
+# a filing fetched on demand (see data_scraping_utils.fetch_fund_filing)
+SAMPLE_FETCH = {
+    "url": "http://sec.gov/test", "holdings": SAMPLE_HOLDINGS, "etag": '"v1"', "last_modified": None,
+    "content_hash": "abc", "document": b"", "report_period": "2025-03-31", "series_lei": None,
+}
 
 
-def test_exposures_uses_cached_nport():
-    finance_utils.FUNDS = {"VFIAX": SAMPLE_NPORT}
-    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
+# ─────────────────────────────────────────────
+# load_holdings()
+# ─────────────────────────────────────────────
 
-    finance_utils.calculate_company_exposures_for_fund("VFIAX", 100)
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={})
+def test_load_holdings_skips_fund_not_in_database(_):
+    assert finance_utils.load_holdings(["MISSING"], MagicMock()) == {}
 
-    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == pytest.approx(250.0)
 
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS})
+def test_load_holdings_uses_cached_holdings(_):
+    with patch("data_scraping_utils.fetch_fund_filing") as mock_fetch:
+        result = finance_utils.load_holdings(["VFIAX"], MagicMock())
 
-def test_exposures_fetches_nport_when_none_in_cache():
-    finance_utils.FUNDS = {"VFIAX": None}
-    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
+    mock_fetch.assert_not_called()
+    assert result == {"VFIAX": SAMPLE_HOLDINGS}
 
-    with patch("finance_utils.data_scraping_utils.fetch_nport_from_sec_url", return_value=SAMPLE_NPORT) as mock_fetch, \
-         patch("finance_utils.db_utils.update_existing_fund") as mock_update:
-        finance_utils.calculate_company_exposures_for_fund("VFIAX", 100)
 
-    mock_fetch.assert_called_once_with("VFIAX")
-    mock_update.assert_called_once()
-    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == pytest.approx(250.0)
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+def test_load_holdings_fetches_nport_when_not_parsed(_):
+    with patch("data_scraping_utils.fetch_fund_filing", return_value=SAMPLE_FETCH) as mock_fetch, \
+         patch("finance_utils.db_utils.store_fetched_filing") as mock_store:
+        conn = MagicMock()
+        result = finance_utils.load_holdings(["VFIAX"], conn)
 
+    # the fetch reads the url from and stores the whole filing in the database it was given, as refresh does
+    mock_fetch.assert_called_once_with("VFIAX", conn)
+    mock_store.assert_called_once_with("VFIAX", "http://sec.gov/test", SAMPLE_FETCH, conn)
+    assert result == {"VFIAX": SAMPLE_HOLDINGS}
 
-def test_exposures_returns_early_when_fetch_fails():
-    finance_utils.FUNDS = {"VFIAX": None}
-    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
 
-    with patch("finance_utils.data_scraping_utils.fetch_nport_from_sec_url", return_value=None):
-        finance_utils.calculate_company_exposures_for_fund("VFIAX", 100)
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+def test_load_holdings_leaves_out_fund_when_fetch_fails(_):
+    with patch("data_scraping_utils.fetch_fund_filing", return_value=None):
+        result = finance_utils.load_holdings(["VFIAX"], MagicMock())
 
-    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == 0.0
+    assert result == {}
 
 
-def test_exposures_unmatched_company_stays_zero():
-    finance_utils.FUNDS = {"VFIAX": SAMPLE_NPORT}
-    finance_utils.COMPANIES_TO_SEARCH = {"Netflix": 0.0}
+# ─────────────────────────────────────────────
+# apply_fund_weights()
+# ─────────────────────────────────────────────
 
-    finance_utils.calculate_company_exposures_for_fund("VFIAX", 1000)
+def test_apply_weights_leaves_unmatched_company_at_zero():
+    result = finance_utils.apply_fund_weights({"VFIAX": 1000}, {"VFIAX": {"Amazon.com Inc": 2.5}}, ["Amazon.com Inc", "Netflix"])
 
-    assert finance_utils.COMPANIES_TO_SEARCH["Netflix"] == 0.0
+    assert result == {"Amazon.com Inc": 2500.0, "Netflix": 0.0}
 
 
-def test_exposures_accumulates_across_multiple_funds():
-    finance_utils.FUNDS = {"VFIAX": SAMPLE_NPORT, "FXAIX": SAMPLE_NPORT}
-    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
+def test_apply_weights_accumulates_across_multiple_funds():
+    fund_weights = {"VFIAX": {"Amazon.com Inc": 2.5}, "FXAIX": {"Amazon.com Inc": 2.5}}
 
-    finance_utils.calculate_company_exposures_for_fund("VFIAX", 100)
-    finance_utils.calculate_company_exposures_for_fund("FXAIX", 200)
+    result = finance_utils.apply_fund_weights({"VFIAX": 100, "FXAIX": 200, "UNKNOWN": 5}, fund_weights, ["Amazon.com Inc"])
 
     # 2.5 * 100 + 2.5 * 200 = 750
-    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == pytest.approx(750.0)
+    assert result == {"Amazon.com Inc": pytest.approx(750.0)}
 
 
 # ─────────────────────────────────────────────
-# timer()
+# scan_fund_holdings()
 # ─────────────────────────────────────────────
 
-def test_timer_sets_start_time_on_first_call():
-    finance_utils.timer()
-    assert finance_utils.START_TIME is not None
-    assert finance_utils.END_TIME is None
+def test_scan_returns_partial_exposures_without_touching_globals():
+    result = finance_utils.scan_fund_holdings(SAMPLE_HOLDINGS, 100, ["Amazon.com Inc", "apple", "Netflix"])
+
+    assert result == {"Amazon.com Inc": pytest.approx(250.0), "apple": pytest.approx(700.0)}
+    assert all(v == 0.0 for v in finance_utils.COMPANIES_TO_SEARCH.values())
+
+
+def test_scan_matches_whole_names_and_identifiers_only():
+    holdings = [
+        ("Metals Corp", "Metals Corp", "", "", 1.0, None),
+        ("Meta Platforms Inc", "Meta Platforms Inc", "BQ4BKCS1HXDV9HN80Z93", "30303M102", 4.0, None),
+    ]
+    companies = {"Meta": ["name:meta"], "META": ["lei:BQ4BKCS1HXDV9HN80Z93", "cusip:30303M102"]}
 
+    assert finance_utils.scan_fund_holdings(holdings, 10, companies) == {"META": pytest.approx(40.0)}
 
-def test_timer_sets_end_time_on_second_call():
-    finance_utils.timer()
-    finance_utils.timer()
-    assert finance_utils.END_TIME is not None
-    assert finance_utils.END_TIME >= finance_utils.START_TIME
+
+def test_search_matches_company_names_inside_holding_names():
+    holdings = SAMPLE_HOLDINGS + [("Apple Hospitality REIT", "Apple Hospitality REIT", "", "", 1.0, None), ("Metals Corp", "Metals Corp", "", "", 1.0, None)]
+    matcher = finance_utils.matching_utils.NameMatcher(["apple", "Meta"])
+
+    assert finance_utils.search_fund_holdings(holdings, 10, matcher) == {"apple": pytest.approx(80.0)}
+
+
+def test_scan_skips_holdings_without_pct_val():
+    holdings = [("Amazon.com Inc", "Amazon.com Inc", "", "", None, None)]
+
+    assert finance_utils.scan_fund_holdings(holdings, 100, ["Amazon.com Inc"]) == {}
 
 
 # ─────────────────────────────────────────────
 # determine_portfolio_exposure()
 # ─────────────────────────────────────────────
 
-@patch("finance_utils.db_utils.connect")
+@patch("finance_utils.db_utils.get_connection")
 @patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 1000)])
-@patch("finance_utils.db_utils.load_funds_from_cache", return_value={"VFIAX": None})
-@patch("finance_utils.data_scraping_utils.fetch_nport_from_sec_url", return_value=None)
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+@patch("data_scraping_utils.fetch_fund_filing", return_value=None)
 def test_portfolio_exposure_handles_missing_nport(*_):
     finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
-    finance_utils.determine_portfolio_exposure()
+    finance_utils.determine_portfolio_exposure("thread")
     assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == 0.0
 
 
-@patch("finance_utils.db_utils.connect")
+@patch("finance_utils.db_utils.get_connection")
 @patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("VFIAX", 200)])
-@patch("finance_utils.db_utils.load_funds_from_cache", return_value={"VFIAX": None})
-@patch("finance_utils.data_scraping_utils.fetch_nport_from_sec_url", return_value=None)
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+@patch("data_scraping_utils.fetch_fund_filing", return_value=None)
 def test_portfolio_exposure_flattens_duplicate_fund_entries(_, mock_load_funds, __, ___):
-    finance_utils.determine_portfolio_exposure()
-    # Flattening is correct if load_funds_from_cache received ["VFIAX"] once, not twice
+    finance_utils.determine_portfolio_exposure("thread")
+    # Flattening is correct if load_fund_holdings received ["VFIAX"] once, not twice
     tickers_requested = mock_load_funds.call_args[0][0]
     assert tickers_requested == ["VFIAX"]
+
+
+@patch("finance_utils.db_utils.get_connection")
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("FXAIX", 200), ("MISSING", 5)])
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS, "FXAIX": SAMPLE_HOLDINGS})
+def test_process_engine_reduces_partial_exposures_from_workers(*_):
+    finance_utils.COMPANIES_TO_SEARCH_KEYS = ["Amazon.com Inc"]
+    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
+
+    finance_utils.determine_portfolio_exposure("process")
+
+    # 2.5 * 100 + 2.5 * 200 = 750
+    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == pytest.approx(750.0)
+
+
+@patch("finance_utils.db_utils.get_connection")
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("FXAIX", 200)])
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS, "FXAIX": SAMPLE_HOLDINGS})
+def test_portfolio_exposure_records_nested_spans_and_counters(*_):
+    instrumentation_utils.reset()
+
+    finance_utils.determine_portfolio_exposure("thread")
+
+    measurements = instrumentation_utils.snapshot()
+    assert {
+        "determine_portfolio_exposure",
+        "determine_portfolio_exposure/compute_exposures",
+        "determine_portfolio_exposure/compute_exposures/match",
+        "determine_portfolio_exposure/compute_exposures/aggregate",
+    } <= set(measurements["spans"])
+    assert measurements["counters"]["positions_scanned"] == 2 * len(SAMPLE_HOLDINGS)
+    assert measurements["counters"]["exposure_results_misses"] == 1
+
+
+# ─────────────────────────────────────────────
+# indexed_fund_weights()
+# ─────────────────────────────────────────────
+
+@patch("finance_utils.db_utils.get_connection")
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("FXAIX", 200), ("VFIAX", 100)])
+@patch("finance_utils.db_utils.load_parsed_funds", return_value={"VFIAX": True, "FXAIX": True})
+@patch("finance_utils.db_utils.lookup_company_exposures", return_value={"Amazon.com Inc": {"VFIAX": 2.5, "FXAIX": 2.0}})
+def test_indexed_exposure_weights_index_lookups_by_shares(mock_lookup, *_):
+    finance_utils.COMPANIES_TO_SEARCH_KEYS = ["Amazon.com Inc"]
+    finance_utils.COMPANIES_TO_SEARCH = {"Amazon.com Inc": 0.0}
+
+    finance_utils.determine_portfolio_exposure()
+
+    assert mock_lookup.call_args[0][1] == ["VFIAX", "FXAIX"]
+    # 2.5 * 200 + 2.0 * 200 = 900
+    assert finance_utils.COMPANIES_TO_SEARCH["Amazon.com Inc"] == pytest.approx(900.0)
+
+
+@patch("finance_utils.db_utils.load_parsed_funds", return_value={"VFIAX": False})
+@patch("finance_utils.db_utils.lookup_company_exposures", return_value={"Amazon.com Inc": {"VFIAX": 2.5}})
+def test_indexed_weights_fetch_unparsed_funds_first(mock_lookup, _):
+    with patch("data_scraping_utils.fetch_fund_filing", return_value=SAMPLE_FETCH), \
+         patch("finance_utils.db_utils.store_fetched_filing") as mock_update:
+        result = finance_utils.indexed_fund_weights(["VFIAX", "MISSING"], ["Amazon.com Inc"], MagicMock())
+
+    mock_update.assert_called_once()
+    assert mock_lookup.call_args[0][1] == ["VFIAX"]
+    assert result == {"VFIAX": {"Amazon.com Inc": 2.5}}
+
+
+# ─────────────────────────────────────────────
+# compute_exposures() / compute_exposures_many()
+# ─────────────────────────────────────────────
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("VFIAX", 100)])
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS})
+def test_compute_exposures_returns_result_without_touching_globals(*_):
+    result = finance_utils.compute_exposures(1, ["Amazon.com Inc", "Netflix"], conn=MagicMock(), engine="thread")
+
+    assert result == {"Amazon.com Inc": 500.0, "Netflix": 0.0}
+    assert all(v == 0.0 for v in finance_utils.COMPANIES_TO_SEARCH.values())
+
+
+@patch("finance_utils.db_utils.load_portfolios", return_value=[(1, "VFIAX", 100), (2, "VFIAX", 10), (2, "FXAIX", 20)])
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS, "FXAIX": SAMPLE_HOLDINGS})
+def test_compute_exposures_many_loads_each_fund_once(mock_load_funds, _):
+    result = finance_utils.compute_exposures_many([1, 2, 3], ["Amazon.com Inc"], conn=MagicMock(), engine="thread")
+
+    mock_load_funds.assert_called_once()
+    assert mock_load_funds.call_args[0][0] == ["VFIAX", "FXAIX"]
+    assert result == {1: {"Amazon.com Inc": 250.0}, 2: {"Amazon.com Inc": 75.0}, 3: {"Amazon.com Inc": 0.0}}
+
+
+# ─────────────────────────────────────────────
+# exposure result cache
+# ─────────────────────────────────────────────
+
+def test_exposure_cache_key_ignores_order_but_not_versions():
+    key = finance_utils.exposure_cache_key({"VFIAX": 100, "FXAIX": 5}, {"VFIAX": 1, "FXAIX": 2}, ["A", "B"], "index")
+
+    assert key == finance_utils.exposure_cache_key({"FXAIX": 5, "VFIAX": 100}, {"FXAIX": 2, "VFIAX": 1}, ["B", "A"], "index")
+    assert key != finance_utils.exposure_cache_key({"VFIAX": 100, "FXAIX": 5}, {"VFIAX": 2, "FXAIX": 2}, ["A", "B"], "index")
+    assert key != finance_utils.exposure_cache_key({"VFIAX": 101, "FXAIX": 5}, {"VFIAX": 1, "FXAIX": 2}, ["A", "B"], "index")
+    assert key != finance_utils.exposure_cache_key({"VFIAX": 100, "FXAIX": 5}, {"VFIAX": 1, "FXAIX": 2}, ["A", "B"], "thread")
+
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100)])
+@patch("finance_utils.db_utils.load_holdings_versions", return_value={"VFIAX": 3})
+@patch("finance_utils.calculate_fund_weights")
+def test_compute_exposures_returns_memoized_result_in_requested_order(mock_weights, *_):
+    with patch("finance_utils.db_utils.load_exposure_result", return_value={"Netflix": 0.0, "Amazon.com Inc": 250.0}):
+        result = finance_utils.compute_exposures(1, ["Amazon.com Inc", "Netflix"], conn=MagicMock())
+
+    mock_weights.assert_not_called()
+    assert list(result.items()) == [("Amazon.com Inc", 250.0), ("Netflix", 0.0)]
+
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100)])
+@patch("finance_utils.db_utils.load_holdings_versions", return_value={"VFIAX": 3})
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS})
+@patch("finance_utils.db_utils.load_parsed_funds", return_value={"VFIAX": True})
+def test_compute_exposures_memoizes_new_results(*_):
+    conn = MagicMock()
+    with patch("finance_utils.db_utils.store_exposure_result") as mock_store:
+        result = finance_utils.compute_exposures(1, ["Amazon.com Inc"], conn=conn, engine="thread")
+
+    cache_key, funds, exposures, used_conn = mock_store.call_args[0]
+    assert cache_key == finance_utils.exposure_cache_key({"VFIAX": 100}, {"VFIAX": 3}, ["Amazon.com Inc"], "thread")
+    assert list(funds) == ["VFIAX"]
+    assert exposures == result == {"Amazon.com Inc": 250.0}
+    assert used_conn is conn
+
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100), ("AAA", 5)])
+@patch("finance_utils.db_utils.load_holdings_versions", return_value={"VFIAX": 3})
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": SAMPLE_HOLDINGS})
+@patch("finance_utils.db_utils.load_parsed_funds", return_value={"VFIAX": True})
+def test_compute_exposures_memoizes_portfolios_holding_funds_outside_the_database(*_):
+    with patch("finance_utils.db_utils.store_exposure_result") as mock_store:
+        finance_utils.compute_exposures(1, ["Amazon.com Inc"], conn=MagicMock(), engine="thread")
+
+    mock_store.assert_called_once()
+
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("VFIAX", 100)])
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"VFIAX": None})
+@patch("finance_utils.db_utils.store_fetched_filing")
+def test_compute_exposures_does_not_memoize_a_result_missing_a_failed_fetch(*_):
+    conn = MagicMock()
+    with patch("data_scraping_utils.fetch_fund_filing", side_effect=[None, SAMPLE_FETCH]) as mock_stream, \
+         patch("finance_utils.db_utils.load_parsed_funds", side_effect=[{"VFIAX": False}, {"VFIAX": True}]), \
+         patch("finance_utils.db_utils.load_holdings_versions", side_effect=[{"VFIAX": 0}, {"VFIAX": 0}, {"VFIAX": 1}]), \
+         patch("finance_utils.db_utils.store_exposure_result") as mock_store:
+        first = finance_utils.compute_exposures(1, ["Amazon.com Inc"], conn=conn, engine="thread")
+        mock_store.assert_not_called()
+
+        second = finance_utils.compute_exposures(1, ["Amazon.com Inc"], conn=conn, engine="thread")
+
+    assert mock_stream.call_count == 2
+    assert first == {"Amazon.com Inc": 0.0}
+    assert second == {"Amazon.com Inc": 250.0}
+    # memoized under the version the successful fetch left behind
+    assert mock_store.call_args[0][0] == finance_utils.exposure_cache_key({"VFIAX": 100}, {"VFIAX": 1}, ["Amazon.com Inc"], "thread")
+
+
+# ─────────────────────────────────────────────
+# look-through (funds held inside funds)
+# ─────────────────────────────────────────────
+
+def test_look_through_order_expands_shared_funds_once_children_first():
+    # target-date fund holds two index funds, which both hold a money-market sleeve
+    links = {"TARGET": [("VTSAX", 60.0), ("VTIAX", 40.0)], "VTSAX": [("MM", 1.0)], "VTIAX": [("MM", 2.0)]}
+
+    order, kept = finance_utils.look_through_order(["TARGET", "VTSAX"], links)
+
+    assert order == ["MM", "VTSAX", "VTIAX", "TARGET"]
+    assert kept["TARGET"] == links["TARGET"]
+
+
+def test_look_through_order_drops_links_that_close_a_cycle():
+    links = {"A": [("B", 10.0)], "B": [("C", 10.0)], "C": [("A", 10.0), ("D", 5.0)]}
+
+    order, kept = finance_utils.look_through_order(["A"], links)
+
+    assert order == ["D", "C", "B", "A"]
+    assert kept["C"] == [("D", 5.0)]
+
+
+def test_expand_fund_weights_multiplies_nested_weights():
+    order, links = finance_utils.look_through_order(["TARGET"], {"TARGET": [("VTSAX", 50.0)], "VTSAX": [("MM", 10.0)]})
+    direct = {"TARGET": {"Amazon.com Inc": 1.0}, "VTSAX": {"Amazon.com Inc": 4.0}, "MM": {"Amazon.com Inc": 20.0}}
+
+    expanded = finance_utils.expand_fund_weights(order, links, direct)
+
+    # VTSAX: 4 + 10% of 20 = 6, TARGET: 1 + 50% of 6 = 4
+    assert expanded["VTSAX"] == {"Amazon.com Inc": pytest.approx(6.0)}
+    assert expanded["TARGET"] == {"Amazon.com Inc": pytest.approx(4.0)}
+
+
+@patch("finance_utils.db_utils.load_user_portfolio", return_value=[("TARGET", 10)])
+@patch("finance_utils.db_utils.load_fund_links", return_value={"TARGET": [("VFIAX", 50.0)]})
+@patch("finance_utils.db_utils.load_fund_holdings", return_value={"TARGET": [], "VFIAX": SAMPLE_HOLDINGS})
+def test_compute_exposures_looks_through_held_funds(mock_load_funds, *_):
+    with patch("finance_utils.db_utils.load_holdings_versions", return_value={}) as mock_versions:
+        result = finance_utils.compute_exposures(1, ["Amazon.com Inc"], conn=MagicMock(), engine="thread")
+
+    assert mock_versions.call_args[0][0] == ["VFIAX", "TARGET"]
+    # 50% of VFIAX's 2.5 * 10 shares
+    assert result == {"Amazon.com Inc": 12.5}